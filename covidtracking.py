@@ -1,79 +1,243 @@
 import pandas as pd
 import numpy as np
+import os
+import pathlib
 from matplotlib import pyplot as plt
 from plots_pylab import limit_xticks
 import common
+import jhu
+import kernels
 from plots_plotly import posNeg_rate_plotly
 
 path='data/covidtracking'
 
-def get_data(trim=False, clip_date=None):
-    tracking_loc=f'{path}/states'
-    csv_file='daily.csv'
-    df = pd.read_csv(f'{tracking_loc}/{csv_file}', dtype={"dataQualityGrade": str})
+try:
+    import pyarrow # (pip install pyarrow) only needed for the on-disk cache
+except ImportError:
+    pyarrow = None
+
+"""
+The columns of daily.csv that get_data keeps unless asked for all of them,
+and their dtypes. The counts
+that can grow past what float32 holds exactly stay float64; the current
+hospital and ICU counts and deaths per state fit in float32.
+"""
+COLUMNS = {
+    'positive': np.float64,
+    'negative': np.float64,
+    'totalTestResults': np.float64,
+    'hospitalizedCurrently': np.float32,
+    'inIcuCurrently': np.float32,
+    'onVentilatorCurrently': np.float32,
+    'death': np.float32,
+    'dataQualityGrade': 'category',
+}
+
+CACHE_VERSION = 1
+
+def read_daily(csv_path, all_columns=False):
+    """
+    Purpose: Parse daily.csv into the columns of COLUMNS with narrow dtypes
+    Input: all_columns, if True, keep the other columns of the CSV as well
+           (with the dtypes read_csv gives them), after those of COLUMNS
+    Returns: a dataframe sorted by state and date
+    """
+    dtypes = {'date': np.int32, 'state': 'category', **COLUMNS}
+    df = pd.read_csv(csv_path, usecols=None if all_columns else list(dtypes), dtype=dtypes)
     df = df.rename(columns={"date": "Last_Update", "state": "Province_State"})
-    df['Province_State'] = df['Province_State'].apply(lambda x: common.merged_d[x])
+    # look up each abbreviation once, not once per row
+    names = [common.merged_d[x] for x in df['Province_State'].cat.categories]
+    df['Province_State'] = df['Province_State'].cat.rename_categories(names)
+    # in order of name, so sorting sorts by name
+    df['Province_State'] = df['Province_State'].cat.reorder_categories(sorted(names))
 
     df.Last_Update = pd.to_datetime(df.Last_Update, format='%Y%m%d')
+    df.sort_values(['Province_State','Last_Update'], inplace=True)
+    df.reset_index(drop=True,inplace=True)
+    first = ['Last_Update', 'Province_State'] + list(COLUMNS)
+    return df[first + [c for c in df.columns if c not in first]]
+
+def load_daily(csv_path, use_cache=True, all_columns=False):
+    """
+    Purpose: read_daily, through a feather cache keyed by the digest of the
+    CSV, so the CSV and its dates are only parsed when it changes
+    Input: use_cache, if True (and pyarrow is installed), use the cache
+           all_columns, as for read_daily (cached separately)
+    Returns: a dataframe
+    """
+    if not use_cache or pyarrow is None:
+        return read_daily(csv_path, all_columns)
+    digest = jhu.hash_file(csv_path)
+    # next to the JHU cache, in data/cache
+    name = 'covidtracking-daily-all' if all_columns else 'covidtracking-daily'
+    cache_path = pathlib.Path(path).parent.joinpath('cache', 
+                    f'{name}-v{CACHE_VERSION}-{digest[:16]}.feather')
+    if cache_path.exists():
+        return pd.read_feather(cache_path)
+
+    df = read_daily(csv_path, all_columns)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    # older versions of the CSV are not needed again
+    for old in cache_path.parent.glob(f'{name}-v*.feather'):
+        old.unlink()
+    tmp = cache_path.with_name(f'{cache_path.name}.{os.getpid()}.tmp')
+    df.to_feather(tmp)
+    tmp.rename(cache_path)
+    return df
+
+def get_data(trim=False, clip_date=None, use_cache=True):
+    """
+    Purpose: Read the covidtracking.com daily state data
+    Input: trim, if True, only keep positive and negative, otherwise keep
+           every column of the CSV
+           clip_date, the earliest date to keep
+           use_cache, as for load_daily
+    Returns: a dataframe sorted by state and date
+    """
+    tracking_loc=f'{path}/states'
+    csv_file='daily.csv'
+    df = load_daily(f'{tracking_loc}/{csv_file}', use_cache=use_cache, all_columns=not trim)
+
     if clip_date:
         # remove data before this date
         df = df[df.Last_Update >= clip_date]
     if trim:
         df = df[['Last_Update', 'Province_State', 'positive', 'negative']]
 
-    df.sort_values(['Province_State','Last_Update'], inplace=True)
-    df.reset_index(drop=True,inplace=True)
-
+    df = df.reset_index(drop=True)
     return df
     
 def filter_by_state(df, state):
-    state_df = pd.DataFrame(df[df.Province_State==state].sort_values(by='Last_Update'))
+    """
+    Purpose: The rows of one state, sorted by date
+    Note: df as get_data returns it is sorted by state and date, so the
+    state's rows are found with a binary search and sliced out
+    Returns: a new dataframe
+    """
+    if df.Province_State.is_monotonic_increasing:
+        states = df.Province_State.to_numpy()
+        (first, last) = (np.searchsorted(states, state, side='left'), 
+                         np.searchsorted(states, state, side='right'))
+        state_df = df.iloc[first:last].copy()
+    else:
+        state_df = df[df.Province_State==state].sort_values(by='Last_Update')
     state_df.reset_index(inplace=True)
     return state_df
     
-def augment(state_df, window=7, last_valid=None):
-    """ add daily and average values to the data """
+def join_states(df, ct_df, columns=None):
+    """
+    Purpose: Add the covidtracking data to a dataframe of states by day 
+    (e.g. the state-level JHU data) without merging: both sides are 
+    numbered by (state, day), the covidtracking values are placed in a 
+    states x days array and each row of df picks its value out of it
+    Input: df, with Province_State and Last_Update columns
+           ct_df, as get_data returns it
+           columns, the covidtracking columns to add (default: the numeric ones)
+    Side effect: Adds the columns to df, NaN where covidtracking has no data,
+      and CT_Last_Update, the last day with a positive count for the state
+      (NaT if there is none)
+    Returns: df
+    """
+    if columns is None:
+        columns = [c for c in ct_df.columns if ct_df[c].dtype.kind in 'iuf']
+    states = pd.Index(pd.unique(ct_df.Province_State.astype(object)))
+    first = min(df.Last_Update.min(), ct_df.Last_Update.min())
+    ndays = (max(df.Last_Update.max(), ct_df.Last_Update.max()) - first).days + 1
+
+    def positions(frame):
+        # (state, day) -> cell of the states x days array, -1 for unknown states
+        state = states.get_indexer(frame.Province_State.astype(object))
+        day = ((frame.Last_Update - first).dt.days).to_numpy()
+        return np.where(state >= 0, state * ndays + day, -1)
+
+    (rows, cells) = (positions(df), positions(ct_df))
+    known = rows >= 0
+    for column in columns:
+        grid = np.full(len(states) * ndays, np.nan)
+        grid[cells] = ct_df[column].to_numpy(dtype=np.float64, na_value=np.nan)
+        df[column] = np.where(known, grid[np.where(known, rows, 0)], np.nan)
+
+    # the last valid day of each state
+    reported = ct_df.positive.notnull().to_numpy()
+    last = np.full(len(states), -1)
+    np.maximum.at(last, cells[reported] // ndays, cells[reported] % ndays)
+    last_valid = pd.Series(first + pd.to_timedelta(last, unit='D')).where(last >= 0)
+    df['CT_Last_Update'] = np.where(known, last_valid.to_numpy()[np.where(known, rows // ndays, 0)],
+                                    np.datetime64('NaT'))
+    return df
+
+def augment(df, window=7, last_valid=None):
+    """
+    Purpose: Add daily and average values to the data of one or more states
+    Input: df, with the rows of each state sorted by date (each state is 
+           computed on its own when there is a Province_State column)
+           last_valid, the last day with valid data, or a column of it 
+           (e.g. CT_Last_Update from join_states)
+    Side effect: Mutates df
+    Returns: df
+    """
+    # every state is one segment, so the daily values and windows stop at its edges
+    if 'Province_State' in df:
+        segments = kernels.Segments(df, 'Province_State')
+    else:
+        segments = kernels.Segments.from_lengths([len(df)])
 
     # replace "NaN" values with zeros
-    state_df['positive'].fillna(0, inplace=True)
-    state_df['negative'].fillna(0, inplace=True)
+    df['positive'].fillna(0, inplace=True)
+    df['negative'].fillna(0, inplace=True)
+    positive = segments.gather(df['positive'])
+    negative = segments.gather(df['negative'])
+    tests = positive + negative
+
+    def daily(values):
+        # the first day of a state counts everything up to it
+        change = kernels.diff(values, segments)
+        return np.where(segments.pos == 0, values, change)
 
     # cumulative
-    state_df['positive_rate'] = state_df.positive / (state_df.positive + state_df.negative)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        positive_rate = positive / tests
 
     # daily
-    state_df['daily_positive'] = state_df.positive.subtract(state_df.positive.shift(1), fill_value=0)
-    state_df['daily_negative'] = state_df.negative.subtract(state_df.negative.shift(1), fill_value=0)
-    
+    daily_positive = daily(positive)
+    daily_negative = daily(negative)
+
     # {window}-day daily test rate
     dp = f'daily_positive_{window}'
     dn = f'daily_negative_{window}'
     dpr= f'daily_positive_rate_{window}'
-    state_df[dp] = state_df.daily_positive.rolling(window=window, min_periods=1, center=False).sum()
-    state_df[dn] = state_df.daily_negative.rolling(window=window, min_periods=1, center=False).sum()
-    state_df[dpr]= state_df[dp]/(state_df[dp] + state_df[dn])
-    
+    positive_window = kernels.rolling_sum(daily_positive, segments, window, min_periods=1)
+    negative_window = kernels.rolling_sum(daily_negative, segments, window, min_periods=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        positive_rate_window = positive_window / (positive_window + negative_window)
+
     # {window}-day daily number of tests average
-    state_df['tests'] = state_df.positive + state_df.negative
-    state_df['daily_tests'] = state_df.tests.subtract(state_df.tests.shift(1), fill_value=0)
+    daily_tests = daily(tests)
     nt = f'daily_tests_{window}'
-    state_df[nt] = state_df.daily_tests.rolling(window=window, min_periods=1, center=False).mean()
+    tests_average = kernels.rolling_mean(daily_tests, segments, window, min_periods=1)
+
+    columns = {'positive_rate': positive_rate, 'daily_positive': daily_positive, 
+               'daily_negative': daily_negative, dp: positive_window, dn: negative_window,
+               dpr: positive_rate_window, 'tests': tests, 'daily_tests': daily_tests, 
+               nt: tests_average}
+    for (column, values) in columns.items():
+        df[column] = segments.scatter(values)
 
     # undo these stats for anything that isn't valid
     if last_valid is not None:
         columns = ['positive', 'negative','positive_rate', 'daily_positive', 
                     'daily_negative', dp, dn, dpr, 'tests', 'daily_tests', nt]
-        state_df.loc[state_df.Last_Update > last_valid, columns] = np.nan
+        # (a missing last valid day means none are valid)
+        df.loc[~(df.Last_Update <= last_valid), columns] = np.nan
 
-
-    return state_df
+    return df
 
 if __name__ == '__main__':
     ct_df = get_data(clip_date='2020-03-15')
     days = 7
     pngScale=0.25
     output = 'inline'
+    augment(ct_df, window=days)
     for state in ['Delaware']:
         state_df = filter_by_state(ct_df, state)
-        augment(state_df, window=days)
         posNeg_rate_plotly(state_df, label=state, days=days, output=output, pngScale=pngScale)    
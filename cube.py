@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# A dense (location x day x metric) array of case data:
+# - build it from the wide JHU dataframe or from an unrolled rowdf
+# - slice it by location or by date range without copying
+# - aggregate locations into states, regions, etc., or into every level
+#   of a hierarchy at once
+# - aggregate counties into any number of overlapping user-defined groups
+# - turn it back into the unrolled rowdf layout used by genstats and plots
+# - store it as memory-mapped files that several processes can share
+
+import pandas as pd
+import numpy as np
+import json
+import os
+import pathlib
+import shutil
+
+import jhu
+
+""" Version of the on-disk layout written by CaseCube.save """
+STORE_VERSION = 1
+
+""" 
+The levels that the graphs are made for, from the finest to the coarsest,
+as (level, location columns). Counties without a Region are left out of
+the region level.
+"""
+HIERARCHY = [
+    ('county', ['Province_State', 'Admin2']),
+    ('region', ['Province_State', 'Region']),
+    ('state', ['Province_State']),
+    ('national', []),
+]
+
+""" Columns that describe a location (rather than a location on a given day) """
+LOCATION_COLUMNS = ['UID', 'iso2', 'iso3', 'code3', 'FIPS', 'Admin2', 'Province_State',
+                    'Country_Region', 'Lat', 'Long_', 'Combined_Key', 'Region', 'Population',
+                    'Grouping', 'Group', 'CT_Last_Update']
+
+###########################################################################
+
+def location_key(locations):
+    """
+    Purpose: The columns that identify a location in a location table:
+    county-level data is keyed on (Province_State, Admin2), region-level data
+    on (Province_State, Region), state-level data on Province_State and the
+    groups of load_groupings on (Grouping, Group).
+    Returns: a list of column names
+    """
+    for key in [['Province_State', 'Admin2'], ['Province_State', 'Region'], ['Province_State'],
+                ['Grouping', 'Group']]:
+        if all(c in locations for c in key):
+            return key
+    return []
+
+def group_codes(df, by):
+    """
+    Purpose: Number the groups formed by the columns in by, in sorted order
+    (as groupby(by, sort=True) would). Rows with a missing key are dropped.
+    Returns:
+      - order: the rows of df that have a key, ordered by group. Rows within
+               a group keep their original order.
+      - starts: the position in order at which each group starts
+      - keys: a dataframe with one row per group holding its key
+    """
+    valid = df[by].notnull().all(axis=1).to_numpy() if by else np.ones(len(df), bool)
+    codes = [pd.factorize(df[c], sort=True)[0] for c in by]
+    order = np.lexsort(codes[::-1]) if by else np.arange(len(df))
+    order = order[valid[order]]
+    if len(order) == 0:
+        return (order, np.zeros(0, dtype=int), df[by].iloc[:0])
+    new = np.zeros(len(order), dtype=bool)
+    new[0] = True
+    for c in codes:
+        c = c[order]
+        new[1:] |= (c[1:] != c[:-1])
+    starts = np.flatnonzero(new)
+    keys = df[by].iloc[order[starts]].reset_index(drop=True)
+    return (order, starts, keys)
+
+###########################################################################
+
+class CaseCube(object):
+    """
+    Case data for a set of locations over a range of consecutive days.
+      - data     : float64 array of shape (locations, days, metrics)
+      - dates    : DatetimeIndex with one entry per day
+      - metrics  : names of the metrics (e.g. 'Confirmed', 'New_Cases')
+      - locations: dataframe with one row of metadata per location
+                   (FIPS, Admin2, Province_State, Region, Population, ...)
+    """
+    def __init__(self, data, dates, locations, metrics, dtypes=None, columns=None):
+        self.data = data
+        self.dates = pd.DatetimeIndex(dates)
+        self.locations = locations.reset_index(drop=True)
+        self.metrics = list(metrics)
+        # dtypes to restore when converting back to a dataframe
+        self.dtypes = dict(dtypes) if dtypes else {}
+        # column order of the dataframe this cube was made from
+        self.columns = columns
+
+        self.key = location_key(self.locations)
+        keys = self.locations[self.key].itertuples(index=False, name=None)
+        self.index = {k: i for (i, k) in enumerate(keys)}
+        # the block of rows of each state (see state_rows)
+        self.state_index = {}
+        if 'Province_State' in self.locations:
+            for (i, state) in enumerate(self.locations['Province_State']):
+                start = self.state_index.get(state, slice(i, i)).start
+                self.state_index[state] = slice(start, i + 1)
+        self.metric_index = {m: k for (k, m) in enumerate(self.metrics)}
+        self.daily = len(self.dates) < 2 or \
+            (self.dates[-1] - self.dates[0]).days == len(self.dates) - 1
+
+    def __repr__(self):
+        return f'CaseCube({len(self.locations)} locations, {len(self.dates)} days, {self.metrics})'
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def __getitem__(self, metric):
+        """ A (locations x days) view of one metric """
+        return self.data[:, :, self.metric_index[metric]]
+
+    ###########################################################################
+    # Conversion
+
+    @classmethod
+    def from_jhudf(cls, jhudf, metric='Confirmed'):
+        """
+        Purpose: Build a cube from the wide JHU dataframe (one column per date).
+        Returns: a CaseCube with a single metric, sorted by location
+        """
+        (date_cols, date_dts) = jhu.date_columns(jhudf)
+        jhudf = jhudf.sort_values(['Province_State', 'Admin2'], kind='mergesort')
+        meta_cols = [c for c in jhudf.columns if c not in set(date_cols)]
+        counts = jhudf[date_cols].to_numpy()
+        data = counts.astype(np.float64)[:, :, np.newaxis]
+        # same column order as jhu.unroll_dates
+        columns = [metric if c == date_cols[0] else c for c in jhudf.columns 
+                   if c in meta_cols or c == date_cols[0]] + ['Last_Update']
+        return cls(data, date_dts, jhudf[meta_cols], [metric],
+                   dtypes={metric: counts.dtype}, columns=columns)
+
+    @classmethod
+    def from_rowdf(cls, rowdf, metrics=None):
+        """
+        Purpose: Build a cube from an unrolled dataframe. The dataframe must
+        have a row for every location on every day, sorted by location and
+        then by Last_Update (as read_annotated_jhu_data returns it).
+        Input: metrics, the columns to keep as metrics. Defaults to every
+               column that isn't Last_Update or in LOCATION_COLUMNS.
+        Returns: a CaseCube
+        """
+        loc_cols = [c for c in rowdf.columns if c in LOCATION_COLUMNS]
+        if metrics is None:
+            metrics = [c for c in rowdf.columns if c not in loc_cols and c != 'Last_Update']
+
+        dates = rowdf['Last_Update'].to_numpy()
+        # the dates of the first location end where the dates stop increasing
+        restarts = np.flatnonzero(dates[1:] <= dates[:-1])
+        ndays = restarts[0] + 1 if len(restarts) else len(dates)
+        nloc = len(rowdf) // ndays if ndays else 0
+        if nloc * ndays != len(rowdf) or \
+           (nloc and not (dates.reshape(nloc, ndays) == dates[:ndays]).all()):
+            raise ValueError('rowdf must have the same consecutive dates for every location')
+
+        data = np.empty((nloc, ndays, len(metrics)))
+        for (k, m) in enumerate(metrics):
+            data[:, :, k] = rowdf[m].to_numpy(dtype=np.float64, na_value=np.nan).reshape(nloc, ndays)
+        locations = rowdf[loc_cols].iloc[::ndays] if ndays else rowdf[loc_cols]
+        dtypes = {m: rowdf[m].dtype for m in metrics}
+        columns = [c for c in rowdf.columns if c in loc_cols or c in metrics or c == 'Last_Update']
+        return cls(data, dates[:ndays], locations, metrics, dtypes=dtypes, columns=columns)
+
+    def to_rowdf(self, columns=None):
+        """
+        Purpose: Unroll the cube into one row per location/date
+        Input: columns, the order of the columns in the result. Defaults to
+               the order of the dataframe the cube was built from.
+        Returns: a new dataframe sorted by location and Last_Update
+        """
+        (nloc, ndays, _) = self.data.shape
+        rowdf = self.locations.iloc[np.repeat(np.arange(nloc), ndays)].reset_index(drop=True)
+        for (k, m) in enumerate(self.metrics):
+            values = self.data[:, :, k].ravel()
+            dtype = self.dtypes.get(m, np.float64)
+            rowdf[m] = values.astype(dtype) if np.dtype(dtype).kind in 'iuf' else values
+        rowdf['Last_Update'] = np.tile(self.dates.values, nloc)
+
+        if columns is None and self.columns is not None and set(self.columns) == set(rowdf.columns):
+            columns = self.columns
+        return rowdf[columns] if columns is not None else rowdf
+
+    ###########################################################################
+    # Slicing
+
+    def location_row(self, *key):
+        """
+        Purpose: Find the row of a location, e.g. location_row('Pennsylvania', 'Delaware')
+        Returns: the row number
+        """
+        return self.index[key]
+
+    def state_rows(self, state):
+        """
+        Purpose: Find the block of rows that belong to a state. Locations are
+        sorted by state so the block is contiguous.
+        Returns: a slice
+        """
+        return self.state_index.get(state, slice(0, 0))
+
+    def day(self, date):
+        """
+        Purpose: Find the column of a date
+        Returns: the day number (0 is the first day in the cube)
+        """
+        date = pd.Timestamp(date)
+        if self.daily:
+            return (date - self.dates[0]).days
+        return self.dates.searchsorted(date)
+
+    def select(self, rows=None, start=None, end=None):
+        """
+        Purpose: Select a block of locations (a slice, e.g. from state_rows,
+        or a single row number) and/or the days from start up to, but not
+        including, end. rows can also be an array of row numbers, in which
+        case the data is copied.
+        Returns: a CaseCube whose data is a view of this cube's data
+        """
+        if rows is None:
+            rows = slice(None)
+        elif isinstance(rows, (int, np.integer)):
+            rows = slice(rows, rows + 1)
+        first = 0 if start is None else max(0, self.day(start))
+        last = len(self.dates) if end is None else max(first, self.day(end))
+        return CaseCube(self.data[rows, first:last], self.dates[first:last],
+                        self.locations.iloc[rows], self.metrics, self.dtypes, self.columns)
+
+    ###########################################################################
+    # Aggregation
+
+    def aggregate(self, by):
+        """
+        Purpose: Sum the locations into the groups given by the location
+        columns in by, e.g. ['Province_State'] or ['Province_State', 'Region'].
+        An empty list sums everything into a single location. Locations with
+        a missing group are left out and missing values count as zero, as
+        with groupby(by).sum().
+        Returns: a new CaseCube, sorted by group
+        """
+        (order, starts, keys) = group_codes(self.locations, by)
+        if len(order):
+            data = np.add.reduceat(np.nan_to_num(self.data[order]), starts, axis=0)
+        else:
+            data = np.zeros((0,) + self.data.shape[1:])
+        if not by:
+            keys = pd.DataFrame(index=range(len(starts)))
+        if 'Population' in self.locations:
+            population = self.locations['Population'].to_numpy(dtype=np.float64, na_value=np.nan)
+            keys['Population'] = np.add.reduceat(np.nan_to_num(population[order]), starts) \
+                if len(order) else []
+        return CaseCube(data, self.dates, keys, self.metrics, self.dtypes)
+
+    def aggregate_groupings(self, groupings):
+        """
+        Purpose: Sum the counties into the groups of load_groupings. Groups
+        can overlap, so this is the product of a sparse (groups x counties)
+        membership matrix, held as (group, county, weight) entries sorted by
+        group, and the (counties x days x metrics) data. Population is summed
+        the same way, so per-capita statistics are population-weighted.
+        Counties that aren't in this cube are left out.
+        Returns: a new CaseCube with one location per (Grouping, Group)
+        """
+        (groups, counties, weights) = ([], [], [])
+        missing = 0
+        for (i, member) in enumerate(groupings.itertuples(index=False)):
+            if pd.isnull(member.Admin2):
+                found = self.state_rows(member.Province_State)
+                found = np.arange(found.start, found.stop)
+            else:
+                key = (member.Province_State, member.Admin2)
+                found = [self.index[key]] if key in self.index else []
+            missing += (len(found) == 0)
+            groups.extend([i] * len(found))
+            counties.extend(found)
+            weights.extend([member.Weight] * len(found))
+        if missing:
+            print(f'Warning: {missing} grouping entries match no counties')
+
+        # number the groups and sort the entries by group
+        (order, starts, keys) = group_codes(groupings.iloc[groups].reset_index(drop=True), ['Grouping', 'Group'])
+        counties = np.asarray(counties, dtype=np.int64)[order]
+        weights = np.asarray(weights, dtype=np.float64)[order]
+        if len(order):
+            weighted = np.nan_to_num(self.data[counties]) * weights[:, np.newaxis, np.newaxis]
+            data = np.add.reduceat(weighted, starts, axis=0)
+        else:
+            data = np.zeros((0,) + self.data.shape[1:])
+        if 'Population' in self.locations:
+            population = self.locations['Population'].to_numpy(dtype=np.float64, na_value=np.nan)
+            keys['Population'] = np.add.reduceat(np.nan_to_num(population[counties]) * weights, starts) \
+                if len(order) else []
+        # shares of a county aren't whole cases
+        dtypes = self.dtypes if (weights == 1).all() else None
+        return CaseCube(data, self.dates, keys, self.metrics, dtypes)
+
+    ###########################################################################
+    # Memory-mapped storage
+
+    def save(self, path):
+        """
+        Purpose: Store the cube in the directory path as a set of files that
+        other processes can attach to without reading them into memory:
+          - data.npy     : the (locations, days, metrics) array
+          - dates.npy    : the dates
+          - locations.pkl: the location table
+          - manifest.json: the shape, metrics, dtypes and column order
+        The files are written to a temporary directory that then replaces
+        path, so processes still attached to an older copy are unaffected.
+        """
+        path = pathlib.Path(path)
+        tmp = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        tmp.mkdir(parents=True, exist_ok=True)
+        np.save(tmp.joinpath('data.npy'), np.ascontiguousarray(self.data))
+        np.save(tmp.joinpath('dates.npy'), self.dates.values.astype('datetime64[D]'))
+        self.locations.to_pickle(tmp.joinpath('locations.pkl'))
+        manifest = {
+            'version': STORE_VERSION,
+            'shape': list(self.data.shape),
+            'metrics': self.metrics,
+            'dtypes': {m: str(np.dtype(d)) for (m, d) in self.dtypes.items()},
+            'columns': self.columns,
+        }
+        with open(tmp.joinpath('manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=1)
+
+        if path.exists():
+            shutil.rmtree(path)
+        tmp.rename(path)
+
+    @classmethod
+    def attach(cls, path):
+        """
+        Purpose: Open a cube stored with save(). The data array is memory-mapped
+        read-only, so it is shared with every other process that attaches to
+        the same files and only the pages that are used get read.
+        Returns: a CaseCube
+        """
+        path = pathlib.Path(path)
+        with open(path.joinpath('manifest.json')) as f:
+            manifest = json.load(f)
+        if manifest['version'] != STORE_VERSION:
+            raise ValueError(f'{path}: store version {manifest["version"]}, expected {STORE_VERSION}')
+        data = np.load(path.joinpath('data.npy'), mmap_mode='r')
+        dates = np.load(path.joinpath('dates.npy'))
+        locations = pd.read_pickle(path.joinpath('locations.pkl'))
+        dtypes = {m: np.dtype(d) for (m, d) in manifest['dtypes'].items()}
+        return cls(data, dates, locations, manifest['metrics'], dtypes, manifest['columns'])
+
+###########################################################################
+# Rollups
+
+def load_groupings(directory=None):
+    """
+    Purpose: Read the user-defined county groupings (metro areas, health
+    districts, media markets, multi-state regions, ...). Each CSV file in 
+    directory (default: data/resources/groupings) is one grouping, named 
+    after the file, with the columns:
+      - Group         : the name of the group
+      - Province_State: the state of a member county
+      - Admin2        : the county, or blank for every county in the state
+      - Weight        : (optional) the share of the county that is in the 
+                        group, e.g. 0.5 for a county split between two groups
+    A county can be in any number of groups. Groupings are applied to the
+    county data after the ingest, so adding one only needs a new file.
+    Returns: a dataframe with the columns Grouping, Group, Province_State,
+             Admin2 and Weight
+    """
+    if directory is None:
+        directory = f'{jhu.population_loc}/groupings'
+    columns = ['Grouping', 'Group', 'Province_State', 'Admin2', 'Weight']
+    frames = []
+    for path in sorted(pathlib.Path(directory).glob('*.csv')):
+        df = pd.read_csv(path, dtype={'Group': str, 'Province_State': str, 'Admin2': str})
+        df['Weight'] = df['Weight'].fillna(1.0) if 'Weight' in df else 1.0
+        df['Grouping'] = path.stem
+        frames.append(df[columns])
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(frames, ignore_index=True)
+
+def rollup(cube, hierarchy=None):
+    """
+    Purpose: Aggregate a county-level cube into every level of a hierarchy
+    at once. Each level is summed from the coarsest level already built
+    that nests inside it and that still includes every county, so e.g. the
+    national totals are summed from the states rather than the counties,
+    while the states are summed from the counties (since not every county
+    is in a region). Every level comes out sorted by its location columns.
+    Input: hierarchy, a list of (level, location columns) from the finest
+           to the coarsest (default HIERARCHY). A level with the location 
+           columns of the cube is the cube itself.
+    Returns: a dictionary of level -> CaseCube
+    """
+    if hierarchy is None:
+        hierarchy = HIERARCHY
+    levels = {}
+    complete = [] # levels that include every county, finest first
+    for (level, by) in hierarchy:
+        if list(by) == cube.key:
+            levels[level] = cube
+            complete.append((level, list(by)))
+            continue
+        source = cube
+        for (other, other_by) in complete:
+            if set(by) <= set(other_by):
+                source = levels[other]
+        levels[level] = source.aggregate(by)
+        if cube.locations[by].notnull().all(axis=None):
+            complete.append((level, list(by)))
+    return levels
@@ -1,50 +1,433 @@
 import time
+import json
+import os
+import concurrent.futures
+import pathlib
+import shutil
 import numpy as np
+import pandas as pd
+
+import kernels
 
 ###########################################################################
 # Generate various statistics on the data
-def gen_statistics(rowdf, groupby, no_trends=False):
+
+""" 
+The statistics gen_statistics adds unless told otherwise, as a list of 
+(metric, windows):
+  - ('new_cases', None) : New_Cases, the daily change in Confirmed
+  - ('average', [7])    : day_avg_7, the 7-day average of New_Cases
+  - ('percap', [7])     : percap_7, new cases per 100K people over 7 days
+  - ('slope', [14])     : slope_14, the slope of the 14-day trendline of 
+                          New_Cases, and trend_14, the number of the last 14
+                          days on which that slope was positive
+Also available (see OPTIONAL_STATISTICS):
+  - ('rt', [7])         : rt_7, the effective reproduction number estimated
+                          from the last 7 days of New_Cases, with the 95% 
+                          credible interval in rt_7_lower and rt_7_upper
+                          (see gen_rt)
+  - ('growth', [14])    : growth_14, the daily growth rate of day_avg_7 from
+                          a 14-day fit in log space, and doubling_14 or 
+                          halving_14, the days it takes to double or halve
+                          at that rate (see gen_growth)
+  - ('seasonal', [28])  : adjusted_28, New_Cases with the day-of-week 
+                          reporting pattern of the last 28 days taken out
+                          (see gen_seasonal_adjustment)
+  - ('centered', [7])   : centered_avg_7, the 7-day average centered on each
+                          day of adjusted_{days} (the first seasonal window),
+                          or of New_Cases without one. It has no lag, but 
+                          the last few days change as new days come in.
+A metric can have several windows, e.g. ('average', [7, 14, 28]).
+"""
+STATISTICS = [
+    ('new_cases', None),
+    ('average', [7]),
+    ('percap', [7]),
+    ('slope', [14]),
+]
+
+"""
+The statistics that are only computed when asked for, by name (e.g. 
+plots.py --statistics rt), since nothing needs them on every run. They are
+added after STATISTICS in this order (see optional_statistics), so centered
+averages the seasonal adjustment when both are asked for. The growth graph
+and the centered average in the new cases graph are only drawn when those
+statistics are computed.
+"""
+OPTIONAL_STATISTICS = {
+    'rt': ('rt', [7]),
+    'growth': ('growth', [14]),
+    'seasonal': ('seasonal', [28]),
+    'centered': ('centered', [7]),
+}
+
+def optional_statistics(names):
+    """
+    Purpose: STATISTICS plus the OPTIONAL_STATISTICS with the given names
+    Returns: a list of (metric, windows)
+    """
+    return STATISTICS + [statistic for (name, statistic) in OPTIONAL_STATISTICS.items() 
+                         if name in names]
+
+"""
+The serial interval, the days between the onset of a case and the onset of 
+the cases it causes, as (mean, standard deviation, longest interval) of a 
+gamma distribution. The default is the estimate of Nishiura et al. (2020).
+"""
+SERIAL_INTERVAL = (4.7, 2.9, 21)
+
+def gen_statistics(rowdf, groupby, no_trends=False, statistics=None, workers=1):
     """
     Purpose: One-stop shopping for adding various statistics such as
     daily new cases, 7-day rolling average, cases per 100K, etc.
+    Input: statistics, the (metric, windows) to add (see STATISTICS, the default).
+           New_Cases is always added since everything else is based on it.
+           no_trends, if True, skip slopes for counties
+           workers, if more than 1, split the groups by state among that
+           many processes (see parallel_statistics)
+    Note: The groups are found once and all of the windows are computed
+    from one set of running sums of New_Cases (see compute_statistics), so
+    extra windows cost very little.
+    Side effect: Mutates the existing dataframe
+    """
+    # every statistic is computed per location over the same segments
+    segments = kernels.Segments(rowdf, groupby)
+    population = segments.gather(rowdf['Population']) if 'Population' in rowdf else None
+    # trendlines won't do counties without force
+    trends = (no_trends==False) or ('Admin2' not in rowdf)
+    confirmed = segments.gather(rowdf['Confirmed'])
+    if workers > 1 and 'Province_State' in rowdf:
+        states = rowdf['Province_State'].to_numpy()
+        states = states[segments.starts] if segments.order is None else states[segments.order[segments.starts]]
+        columns = parallel_statistics(confirmed, population, segments, states, workers,
+                                      statistics, trends)
+    else:
+        columns = compute_statistics(confirmed, population, segments, statistics, trends)
+    for (column, values) in columns.items():
+        rowdf[column] = segments.scatter(values)
+    # rows left out of every group (a missing key) have no new cases either
+    rowdf['New_Cases'].fillna(0, inplace=True)
+
+    # Generate 14-day trendlines -- won't do counties by without force
+    #gen_trend_alternate(rowdf, groupby)
+
+def compute_statistics(confirmed, population, segments, statistics=None, trends=True):
+    """
+    Purpose: Compute the columns gen_statistics adds, for any data laid out
+    in segments (the rows of a dataframe, or a CaseCube's locations x days)
+    Input: confirmed and population, arrays in group order
+           statistics, as for gen_statistics
+           trends, if False, leave out slope_{days} and trend_{days}
+    Returns: a dictionary of column name -> array in group order
     """
+    if statistics is None:
+        statistics = STATISTICS
+
     # generate new case counts
-    gen_new_cases(rowdf, groupby)
+    new_cases = kernels.diff(confirmed, segments)
+    columns = {'New_Cases': np.where(np.isnan(new_cases), 0, new_cases)}
+    sums = kernels.RunningSums(columns['New_Cases'], segments)
 
-    # Add {days}-day moving average
-    days = 7
-    gen_average_new_cases(rowdf, groupby, days)
+    for (metric, windows) in statistics:
+        for days in (windows or []):
+            if metric in ['average', 'percap']:
+                # Add {days}-day moving average
+                average = f'day_avg_{days}'
+                if average not in columns:
+                    columns[average] = kernels.rolling_mean(sums, segments, days, min_periods=1)
+                # Add {days}-day/per 100K
+                if metric == 'percap':
+                    with np.errstate(divide='ignore', invalid='ignore'): # as pandas would
+                        columns[f'percap_{days}'] = columns[average]/population*100000*days
+            elif metric == 'slope':
+                # Generate trendlines the original way
+                if trends:
+                    slope = kernels.rolling_slope(sums, segments, days)
+                    columns[f'slope_{days}'] = slope
+                    columns[f'trend_{days}'] = kernels.rolling_count_positive(slope, segments, days)
+            elif metric == 'rt':
+                (rt, lower, upper) = gen_rt(columns['New_Cases'], segments, days)
+                columns[f'rt_{days}'] = rt
+                columns[f'rt_{days}_lower'] = lower
+                columns[f'rt_{days}_upper'] = upper
+            elif metric == 'growth':
+                average = columns.get('day_avg_7')
+                if average is None:
+                    average = kernels.rolling_mean(sums, segments, 7, min_periods=1)
+                (growth, doubling, halving) = gen_growth(average, segments, days)
+                columns[f'growth_{days}'] = growth
+                columns[f'doubling_{days}'] = doubling
+                columns[f'halving_{days}'] = halving
+            elif metric == 'seasonal':
+                columns[f'adjusted_{days}'] = gen_seasonal_adjustment(columns['New_Cases'], 
+                                                                      segments, days)
+            elif metric == 'centered':
+                adjusted = [c for c in columns if c.startswith('adjusted_')]
+                daily = columns[adjusted[0]] if adjusted else columns['New_Cases']
+                columns[f'centered_avg_{days}'] = kernels.centered_mean(daily, segments, days)
+            else:
+                raise ValueError(f'Unknown statistic: {metric}')
+    return columns
 
-    # Add {days}-day/per 100K
-    rowdf[f'percap_{days}'] = rowdf[f'day_avg_{days}']/rowdf['Population']*100000*days
+def gen_cube_statistics(cubes, no_trends=False, statistics=None, workers=1):
+    """
+    Purpose: Compute the statistics of several CaseCubes with the same dates
+    (e.g. the levels from cube.rollup) in one pass over all of them
+    Input: cubes, a list of CaseCubes with a Confirmed metric
+           no_trends, if True, skip slopes for county-level cubes
+           statistics and workers, as for gen_statistics
+    Returns: a list of new CaseCubes with the statistics added as metrics
+    """
+    ndays = len(cubes[0].dates)
+    counts = [len(c.locations) for c in cubes]
+    confirmed = np.concatenate([c['Confirmed'] for c in cubes]).ravel()
+    population = np.concatenate([
+        np.repeat(c.locations['Population'].to_numpy(dtype=np.float64, na_value=np.nan), ndays)
+        if 'Population' in c.locations else np.full(n * ndays, np.nan)
+        for (c, n) in zip(cubes, counts)])
+    segments = kernels.Segments.regular(sum(counts), ndays)
+    if workers > 1:
+        states = np.concatenate([
+            c.locations['Province_State'].astype(object).to_numpy()
+            if 'Province_State' in c.locations else np.full(n, '')
+            for (c, n) in zip(cubes, counts)])
+        columns = parallel_statistics(confirmed, population, segments, states, workers, 
+                                      statistics)
+    else:
+        columns = compute_statistics(confirmed, population, segments, statistics)
 
-    # Generate 14-day trendlines the original way -- won't do counties by without force
-    gen_trend_original(rowdf, groupby, days=14, force=(no_trends==False))
+    result = []
+    offsets = np.cumsum([0] + counts) * ndays
+    for (c, first, last) in zip(cubes, offsets[:-1], offsets[1:]):
+        trends = (no_trends==False) or ('Admin2' not in c.locations)
+        names = [name for name in columns if trends or not name.startswith(('slope_', 'trend_'))]
+        stats = np.stack([columns[name][first:last].reshape(-1, ndays) for name in names], axis=2)
+        order = c.columns + names if c.columns is not None else None
+        result.append(type(c)(np.concatenate([c.data, stats], axis=2), c.dates, c.locations, 
+                              c.metrics + names, c.dtypes, order))
+    return result
 
-    # Generate 14-day trendlines -- won't do counties by without force
-    #gen_trend_alternate(rowdf, groupby)
+###########################################################################
+# Parallel statistics
+#
+# The statistics of a location only depend on its own rows, so the groups 
+# can be split into contiguous chunks that worker processes compute on
+# their own. The chunks are cut where the state changes, so a state is 
+# never split, and are about the same number of rows. Each worker gets 
+# plain arrays rather than a dataframe, and the columns it returns are 
+# put back together in the original order. The results are the same as 
+# compute_statistics over all of the groups at once.
+
+def partition_segments(segments, states, chunks):
+    """
+    Purpose: Split segments into about {chunks} contiguous runs of about the
+    same number of rows, cutting only where the state changes
+    Input: states, the state of each segment
+    Returns: an array of segment numbers, the first of each run followed by
+             len(segments)
+    """
+    codes = pd.factorize(pd.Series(states).astype(str))[0]
+    bounds = np.concatenate([[0], np.flatnonzero(codes[1:] != codes[:-1]) + 1, [len(segments)]])
+    offsets = np.append(segments.starts, segments.size)[bounds]
+    targets = segments.size * np.arange(1, chunks) / chunks
+    cuts = bounds[np.searchsorted(offsets, targets)]
+    return np.unique(np.concatenate([[0], cuts, [len(segments)]]))
+
+def chunk_statistics(confirmed, population, lengths, statistics, trends):
+    """ compute_statistics for one chunk of groups, in a worker process """
+    segments = kernels.Segments.from_lengths(lengths)
+    return compute_statistics(confirmed, population, segments, statistics, trends)
+
+def parallel_statistics(confirmed, population, segments, states, workers, 
+                        statistics=None, trends=True):
+    """
+    Purpose: compute_statistics split by state among {workers} processes
+    Input: states, the state of each segment
+           the others, as for compute_statistics
+    Returns: a dictionary of column name -> array in group order
+    """
+    cuts = partition_segments(segments, states, workers)
+    offsets = np.append(segments.starts, segments.size)[cuts]
+    lengths = segments.lengths
+    print(f'Computing statistics for {len(segments)} locations in {len(cuts)-1} chunks '
+          f'with {workers} workers')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(chunk_statistics, confirmed[first:last],
+                               None if population is None else population[first:last],
+                               lengths[start:end], statistics, trends)
+                   for (first, last, start, end) 
+                   in zip(offsets[:-1], offsets[1:], cuts[:-1], cuts[1:])]
+        results = [future.result() for future in futures]
+    return {column: np.concatenate([result[column] for result in results]) 
+            for column in results[0]}
+
+###########################################################################
+# Effective reproduction number
+#
+# Rt is estimated the way Cori et al. (2013) do it: by the renewal equation,
+# the new cases I_t on day t are Poisson with mean Rt * L_t, where
+#     L_t = sum over k >= 1 of w_k * I_{t-k}
+# is the infection pressure from earlier cases, weighted by the serial 
+# interval distribution w. Assuming Rt is constant over the last {days} days
+# and starting from a Gamma(shape=a, scale=b) prior, the posterior of Rt is
+# Gamma(shape = a + sum of I, rate = 1/b + sum of L) over the window.
+# Every location is done at once: the sums of L are a convolution of the 
+# window sums of I with w (kernels.lagged_sum), one array operation per lag.
+
+def serial_interval_weights(serial_interval=None):
+    """
+    Purpose: Discretize the serial interval distribution
+    Input: serial_interval, (mean, sd, longest interval), see SERIAL_INTERVAL
+    Returns: an array of weights for intervals of 1, 2, ... days, summing to 1
+    """
+    (mean, sd, longest) = serial_interval or SERIAL_INTERVAL
+    (shape, scale) = ((mean / sd)**2, sd**2 / mean)
+    days = np.arange(1, longest + 1)
+    # the gamma density up to a constant factor
+    weights = np.exp((shape - 1) * np.log(days) - days / scale)
+    return weights / weights.sum()
+
+def gamma_quantile(shape, rate, z):
+    """
+    Purpose: The Wilson-Hilferty approximation to a quantile of a gamma 
+    distribution, accurate to well under 1% for shape >= 1
+    Input: z, the matching quantile of the standard normal distribution
+    Returns: an array
+    """
+    return shape * (1 - 1/(9*shape) + z/(3*np.sqrt(shape)))**3 / rate
+
+def gen_rt(new_cases, segments, days=7, serial_interval=None, prior=(1, 5), max_cv=0.3):
+    """
+    Purpose: Estimate the effective reproduction number from the last {days}
+    days of new cases in each segment (see above)
+    Input: new_cases, an array in group order (negative corrections count as 0)
+           serial_interval, see SERIAL_INTERVAL
+           prior, (shape, scale) of the gamma prior on Rt
+           max_cv, leave out estimates whose posterior coefficient of 
+           variation is larger than this, i.e. those based on too few cases
+    Returns: (posterior mean, 2.5% quantile, 97.5% quantile), arrays that are
+             NaN for the first {days} days of a segment, when there is no
+             infection pressure, or when there are too few cases
+    """
+    incidence = np.maximum(np.where(np.isnan(new_cases), 0, new_cases), 0)
+    (cases, _, _) = kernels.RunningSums(incidence, segments).window(days)
+    pressure = kernels.lagged_sum(cases, segments, serial_interval_weights(serial_interval))
+    shape = prior[0] + cases
+    rate = 1/prior[1] + pressure
+    valid = (segments.pos >= days) & (pressure > 0) & (shape >= 1/max_cv**2)
+    rt = np.where(valid, shape / rate, np.nan)
+    lower = np.where(valid, gamma_quantile(shape, rate, -1.959964), np.nan)
+    upper = np.where(valid, gamma_quantile(shape, rate, 1.959964), np.nan)
+    return (rt, lower, upper)
 
+###########################################################################
+# Growth rate and doubling time
+#
+# A slope of new cases means something different in a county of 5,000 than
+# in one of 5 million, but a growth rate does not. Fitting a line to 
+# log(day_avg_7) over {days} days gives the exponential rate r at which the
+# average is changing, so it grows by exp(r) - 1 a day and doubles (or 
+# halves) every log(2)/|r| days. The least-squares slope of a full window is
+# a fixed weighted sum of its values, so every location's fits are one 
+# kernels.rolling_filter. (The running sums rolling_slope uses would give 
+# logs a little roundoff from the rest of the column, enough to flip the 
+# sign of a rate near 0 between a full and an incremental update.)
+
+def gen_growth(average, segments, days=14):
+    """
+    Purpose: The growth rate of a 7-day average of new cases from a 
+    least-squares line through its logs over the last {days} days
+    Input: average, day_avg_7 as an array in group order
+    Returns: (daily growth rate, doubling time, halving time) as arrays. 
+             All are NaN until the window is full of complete 7-day 
+             averages, or if any average in the window is 0 (no log). The 
+             doubling time is NaN unless cases are growing, the halving time
+             unless they are shrinking.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        logs = np.where(average > 0, np.log(average), np.nan)
+    x = np.arange(days) - (days - 1) / 2
+    rate = kernels.rolling_filter(logs, segments, x / (x * x).sum())
+    # wait for {days} full 7-day averages after the placeholder 0 on the first day
+    rate[segments.pos < days + 6] = np.nan
+    growth = np.expm1(rate)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        doubling = np.where(rate > 0, np.log(2) / rate, np.nan)
+        halving = np.where(rate < 0, -np.log(2) / rate, np.nan)
+    return (growth, doubling, halving)
+
+###########################################################################
+# Day-of-week seasonality
+#
+# Fewer cases are reported on weekends and more early in the week, which the
+# trailing 7-day average smooths out at the cost of lagging by half a week.
+# Over a trailing window of whole weeks, the reporting factor of a weekday
+# is the mean of new cases on that weekday over the mean of all days:
+#     factor = (sum on the weekday / weeks) / (sum / days)
+# Dividing each day by the factor of its weekday gives a daily series with 
+# the reporting pattern taken out. The rows of a location are consecutive
+# days, so the same weekday is every 7th row and no dates are needed.
+
+def gen_seasonal_adjustment(new_cases, segments, days=28):
+    """
+    Purpose: Take the day-of-week reporting pattern out of daily new cases,
+    with each location's weekday factors estimated over the last {days} days
+    Input: new_cases, an array in group order
+           days, the window, a multiple of 7
+    Returns: an array of adjusted new cases, NaN until a location has {days}
+             days of new cases. A day whose weekday has no cases in the 
+             window (e.g. no weekend reporting) gets the window's mean.
+    """
+    if days % 7 != 0:
+        raise ValueError(f'The seasonal window must be whole weeks, not {days} days')
+    weeks = days // 7
+    (total, _, _) = kernels.RunningSums(new_cases, segments).window(days)
+    weekday = kernels.rolling_sum_every(new_cases, segments, weeks, 7)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        factor = (weekday / weeks) / (total / days)
+        adjusted = np.where(factor > 0, new_cases / factor, np.maximum(total, 0) / days)
+    # the first day's new cases are a placeholder
+    adjusted[segments.pos < days] = np.nan
+    return adjusted
 
 ###########################################################################
-def gen_new_cases(rowdf, groupby):
+def gen_new_cases(rowdf, groupby, segments=None):
     """
     Purpose: Add the new_cases column to the dataframe
     Inputs: row dataframe (rowdf) and how to groupby (state, county, region)
+            segments, a kernels.Segments for groupby if there already is one
     Side effect: Mutates the existing dataframe
     """
-    rowdf['New_Cases'] = rowdf.groupby(groupby)['Confirmed'].diff()
+    if segments is None:
+        segments = kernels.Segments(rowdf, groupby)
+    new_cases = kernels.diff(segments.gather(rowdf['Confirmed']), segments)
+    rowdf['New_Cases'] = segments.scatter(new_cases)
     rowdf['New_Cases'].fillna(0, inplace=True)
 
-def gen_average_new_cases(rowdf, groupby, days):
+def gen_average_new_cases(rowdf, groupby, days, segments=None, sums=None):
     """
     Purpose: Add the day_avg_{days} column to the dataframe
     Inputs: row dataframe (rowdf), days to average over (days),
             and how to groupby (state, county, region)
+            segments, a kernels.Segments for groupby if there already is one
+            sums, a kernels.RunningSums of New_Cases if there already is one
     Side effect: Mutates the existing dataframe
     """
+    if segments is None:
+        segments = kernels.Segments(rowdf, groupby)
+    if sums is None:
+        sums = segments.gather(rowdf['New_Cases'])
     field = f'day_avg_{days}'
-    rollfn = lambda x: x.rolling(window=days, min_periods=1).mean()
-    rowdf[field] = rowdf.groupby(groupby)['New_Cases'].transform(rollfn)
+    average = kernels.rolling_mean(sums, segments, days, min_periods=1)
+    rowdf[field] = segments.scatter(average)
+
+def gen_percap(rowdf, days):
+    """
+    Purpose: Add the percap_{days} column, new cases per 100K people over
+    {days} days, from the day_avg_{days} column
+    Side effect: Mutates the existing dataframe
+    """
+    rowdf[f'percap_{days}'] = rowdf[f'day_avg_{days}']/rowdf['Population']*100000*days
 
 def fit(period):
     """ A function to find the best-fit line for a period of data """
@@ -54,33 +437,30 @@ def fit(period):
         m, _ = np.polyfit(np.arange(len(period)), period, 1)
         return m
 
-
-def gen_trend_original(rowdf, groupby, days=14, force=False):
+def gen_trend_original(rowdf, groupby, days=14, force=False, segments=None, sums=None):
     """ 
-    **** Warning: this function is quite slow for counties ****
-
     Purpose: compute the trendline for the past {days} days as slope_{days}
     and the number of days within those {days} that the trend is worsening
     (positive) or improving (negative) as trend_{days}
+    Note: Both are computed for all groups at once from running sums (see
+    kernels.rolling_slope), so counties cost about as much as the 7-day average.
+    Input: segments and sums, as for gen_average_new_cases
     Side effect: Mutates the df to include slope_{days} and trend_{days}
     """
     if (not force) and ('Admin2' in rowdf): return
+    if segments is None:
+        segments = kernels.Segments(rowdf, groupby)
+    if sums is None:
+        sums = segments.gather(rowdf['New_Cases'])
 
     # Get the slope of the trend line for the past {days} days.
     sfield=f'slope_{days}'
-    rollfn = lambda x: x.rolling(window=days, min_periods=1).apply(fit)
-    rowdf[sfield] = rowdf.groupby(groupby)['New_Cases'].transform(rollfn)
+    slope = kernels.rolling_slope(sums, segments, days)
+    rowdf[sfield] = segments.scatter(slope)
 
     # Get the number of times the slope was positive in last {days} days.
     tfield = f'trend_{days}'
-    rollfn1 = lambda x: x.rolling(window=days, min_periods=days).apply(lambda x: (x>0).sum())
-    #rollfn2 = lambda x: x.rolling(window=days, min_periods=days).apply(lambda x: x.gt(0).sum())
-
-    if 'Admin2' in rowdf: print(f'Generating county trends')
-    s = time.time()
-    rowdf[tfield] = rowdf.groupby(groupby)[sfield].transform(rollfn1)
-    e = time.time()
-    if 'Admin2' in rowdf: print(f'Elapsed: {e-s}s')
+    rowdf[tfield] = segments.scatter(kernels.rolling_count_positive(slope, segments, days))
 
 def gen_trend_alternate(rowdf, groupby, days=14, force=False):
     """ 
@@ -96,10 +476,294 @@ def gen_trend_alternate(rowdf, groupby, days=14, force=False):
     tfield = f'trend_{days}'
     sfield = f'day_avg_7_diff'
     # hard code 7 bc day_avg_14 prob doesn't exist. we could make it if needed
-    rowdf[sfield] = rowdf.groupby(groupby)['day_avg_7'].diff(periods=7)
-    rollfn1 = lambda x: x.rolling(window=days, min_periods=days).apply(lambda x: (x>0).sum())
+    segments = kernels.Segments(rowdf, groupby)
+    avg_diff = kernels.diff(segments.gather(rowdf['day_avg_7']), segments, periods=7)
+    rowdf[sfield] = segments.scatter(avg_diff)
     s = time.time()
-    rowdf[tfield] = rowdf.groupby(groupby)[sfield].transform(rollfn1)
+    rowdf[tfield] = segments.scatter(kernels.rolling_count_positive(avg_diff, segments, days))
     e = time.time()
     print(f'Elapsed: {e-s}s')
 
+
+###########################################################################
+# Daily ranks
+#
+# Where a location stands among all of the locations on the same day, e.g.
+# the percentile of a county's percap_7 nationally and in its state. Rows
+# are grouped by day (and state) with one lexsort, so every day is ranked
+# at once, and the top few of each day come from a partial selection 
+# (np.argpartition) of a days x locations array instead of a full sort.
+
+""" The statistics gen_ranks ranks unless told otherwise """
+RANKS = ['percap_7']
+
+def percentile_ranks(values, codes):
+    """
+    Purpose: The percentile rank of each value among the values with the 
+    same code, i.e. what groupby(codes).rank(pct=True)*100 gives
+    Input: values, an array with NaN for missing values
+           codes, an array of group numbers, < 0 for rows not in any group
+    Returns: an array of percentiles in (0, 100], NaN for missing values
+             and rows not in any group
+    """
+    result = np.full(len(values), np.nan)
+    ranked = np.flatnonzero(codes >= 0)
+    if len(ranked) == 0:
+        return result
+    (values, codes) = (values[ranked], codes[ranked])
+    order = np.lexsort((values, codes))
+    (ordered, groups) = (values[order], codes[order])
+    present = ~np.isnan(ordered)
+    counts = np.bincount(groups[present], minlength=codes.max() + 1 if len(codes) else 0)
+    # position among the group's values (NaNs sort last)
+    new_group = np.ones(len(order), dtype=bool)
+    new_group[1:] = groups[1:] != groups[:-1]
+    starts = np.flatnonzero(new_group)
+    position = np.arange(len(order)) - np.repeat(starts, np.diff(np.append(starts, len(order))))
+    # ties get the mean of their positions
+    new_run = new_group.copy()
+    new_run[1:] |= ordered[1:] != ordered[:-1]
+    run_starts = np.flatnonzero(new_run)
+    run_ends = np.append(run_starts[1:], len(order)) - 1
+    runs = np.cumsum(new_run) - 1
+    rank = (position[run_starts] + position[run_ends])[runs] / 2 + 1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result[ranked[order]] = np.where(present, rank / counts[groups] * 100, np.nan)
+    return result
+
+def gen_ranks(rowdf, metrics=None, within='Province_State'):
+    """
+    Purpose: Rank each row among the rows of rowdf for the same day
+    Input: metrics, the columns to rank (see RANKS, the default)
+           within, the column to also rank within (e.g. the state), or None
+    Side effect: Adds {metric}_pct, the percentile among all rows of the 
+      day (100 is the highest), and {metric}_{within}_pct, the percentile
+      among the rows of the day with the same {within}, e.g. percap_7_pct
+      and percap_7_state_pct
+    """
+    if metrics is None:
+        metrics = RANKS
+    days = rowdf.groupby('Last_Update', sort=False).ngroup().to_numpy()
+    if within is not None:
+        # rows with a missing {within} aren't ranked within it (ngroup gives NaN)
+        places = rowdf.groupby(['Last_Update', within], sort=False, observed=True).ngroup()
+        places = places.fillna(-1).to_numpy(dtype=np.int64)
+        suffix = 'state' if within == 'Province_State' else within
+    for metric in metrics:
+        values = rowdf[metric].to_numpy(dtype=np.float64, na_value=np.nan)
+        rowdf[f'{metric}_pct'] = percentile_ranks(values, days)
+        if within is not None:
+            rowdf[f'{metric}_{suffix}_pct'] = percentile_ranks(values, places)
+
+def gen_hotspots(rowdf, groupby, metric='percap_7', k=25):
+    """
+    Purpose: List the {k} locations with the highest {metric} on each day
+    Input: groupby, the columns that identify a location
+    Returns: a dataframe of Last_Update, Rank (1 is the highest), the 
+             groupby columns and {metric}, sorted by day and rank
+    """
+    (days, dates) = pd.factorize(rowdf['Last_Update'], sort=True)
+    locations = rowdf.groupby(groupby, sort=False).ngroup().to_numpy()
+    keys = rowdf[groupby].iloc[np.unique(locations, return_index=True)[1]].reset_index(drop=True)
+    values = rowdf[metric].to_numpy(dtype=np.float64, na_value=np.nan)
+
+    # days x locations, with missing values at the bottom
+    table = np.full((len(dates), len(keys)), -np.inf)
+    table[days, locations] = np.where(np.isnan(values), -np.inf, values)
+    k = min(k, len(keys))
+    top = np.argpartition(-table, k - 1, axis=1)[:, :k]
+    # only the top k of each day get sorted
+    top = np.take_along_axis(top, np.argsort(-np.take_along_axis(table, top, axis=1), 
+                                             axis=1, kind='stable'), axis=1)
+    best = np.take_along_axis(table, top, axis=1)
+    (day, rank) = np.nonzero(best > -np.inf)
+
+    hotspots = keys.iloc[top[day, rank]].reset_index(drop=True)
+    hotspots.insert(0, 'Last_Update', dates[day])
+    hotspots.insert(1, 'Rank', rank + 1)
+    hotspots[metric] = best[day, rank]
+    return hotspots
+
+###########################################################################
+# Incremental statistics
+#
+# The statistics of a row only depend on the few rows before it in the same
+# group (see statistics_lookback). update_statistics saves the statistics it
+# computes along with the Confirmed history of each group. If the next rowdf
+# has the same history with new days added, only the new rows are computed,
+# from the tail of each group's history, so a daily update costs 
+# O(groups x lookback) instead of a pass over every row. A revised history 
+# or a revised population (which percap_{days} divides by) means a full
+# recompute.
+
+STATE_VERSION = 2
+
+def statistics_lookback(statistics):
+    """
+    Purpose: How many earlier rows of a group the statistics of a row depend on
+    Returns: a number of rows
+    """
+    lookback = 1 # New_Cases needs the day before
+    for (metric, windows) in statistics:
+        for days in (windows or []):
+            # a trend counts {days} slopes, each made from {days} new cases
+            if metric == 'slope':
+                lookback = max(lookback, 2*days - 1)
+            # Rt looks back over the serial interval from each of {days} days
+            elif metric == 'rt':
+                lookback = max(lookback, days + SERIAL_INTERVAL[2])
+            # growth fits {days} 7-day averages
+            elif metric == 'growth':
+                lookback = max(lookback, days + 6)
+            # a centered average looks back half its window from the 
+            # earliest day, which looks back over its own window
+            elif metric == 'centered':
+                seasonal = [w for (m, ws) in statistics if m == 'seasonal' for w in ws]
+                lookback = max(lookback, days // 2 + max(seasonal, default=1))
+            else:
+                lookback = max(lookback, days)
+    return lookback
+
+def statistics_lookahead(statistics):
+    """
+    Purpose: How many later rows of a group the statistics of a row depend on
+    Returns: a number of rows
+    """
+    lookahead = 0
+    for (metric, windows) in statistics:
+        if metric == 'centered':
+            lookahead = max([lookahead] + [days - 1 - days // 2 for days in windows])
+    return lookahead
+
+def load_statistics_state(path):
+    """
+    Purpose: Read the state saved by update_statistics
+    Returns: a dictionary, or None if there is no usable state at path
+    """
+    path = pathlib.Path(path)
+    if not path.joinpath('manifest.json').exists():
+        return None
+    with open(path.joinpath('manifest.json')) as f:
+        state = json.load(f)
+    if state['version'] != STATE_VERSION:
+        return None
+    state['keys'] = pd.read_pickle(path.joinpath('keys.pkl'))
+    for name in ['lengths', 'population', 'confirmed', 'dates', 'stats']:
+        state[name] = np.load(path.joinpath(f'{name}.npy'))
+    return state
+
+def group_population(rowdf, segments):
+    """ The Population of the first row of each group, or NaN if rowdf has none """
+    if 'Population' not in rowdf:
+        return np.full(len(segments), np.nan)
+    return segments.gather(rowdf['Population'])[segments.starts]
+
+def save_statistics_state(path, rowdf, segments, settings, columns):
+    """
+    Purpose: Save what update_statistics needs to extend rowdf next time:
+      - manifest.json: the settings and the names of the statistics columns
+      - keys.pkl     : the key of each group
+      - lengths.npy  : the number of rows in each group
+      - population.npy: the Population of each group (NaN without one)
+      - confirmed.npy, dates.npy: the history, to detect revisions
+      - stats.npy    : the statistics columns
+    """
+    path = pathlib.Path(path)
+    tmp = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    tmp.mkdir(parents=True, exist_ok=True)
+    rowdf[settings['groupby']].iloc[segments.starts].reset_index(drop=True).to_pickle(tmp.joinpath('keys.pkl'))
+    np.save(tmp.joinpath('lengths.npy'), segments.lengths)
+    np.save(tmp.joinpath('population.npy'), group_population(rowdf, segments))
+    np.save(tmp.joinpath('confirmed.npy'), segments.gather(rowdf['Confirmed']))
+    np.save(tmp.joinpath('dates.npy'), rowdf['Last_Update'].to_numpy())
+    np.save(tmp.joinpath('stats.npy'), 
+            np.column_stack([rowdf[c].to_numpy(dtype=np.float64) for c in columns]))
+    with open(tmp.joinpath('manifest.json'), 'w') as f:
+        json.dump({'version': STATE_VERSION, 'settings': settings, 'columns': columns}, f, indent=1)
+
+    if path.exists():
+        shutil.rmtree(path)
+    tmp.rename(path)
+
+def saved_lengths(rowdf, segments, state, settings):
+    """
+    Purpose: Check whether each group of rowdf is the group saved in state
+    with zero or more rows added at the end, and the same Population
+    Returns: the number of saved rows in each group, or None
+    """
+    if state['settings'] != settings or len(state['lengths']) != len(segments):
+        return None
+    keys = rowdf[settings['groupby']].iloc[segments.starts].astype(object).to_numpy()
+    if not (keys == state['keys'].astype(object).to_numpy()).all():
+        return None
+    if not np.array_equal(group_population(rowdf, segments), state['population'], equal_nan=True):
+        return None
+    saved = state['lengths']
+    if (segments.lengths < saved).any():
+        return None
+    rows = kernels.ranges(segments.starts, saved)
+    confirmed = segments.gather(rowdf['Confirmed'])[rows]
+    dates = rowdf['Last_Update'].to_numpy()[rows]
+    if not (np.array_equal(confirmed, state['confirmed'], equal_nan=True) and
+            np.array_equal(dates, state['dates'])):
+        return None
+    return saved
+
+def update_statistics(rowdf, groupby, path, no_trends=False, statistics=None, workers=1):
+    """
+    Purpose: gen_statistics for a rowdf that has grown by a few days since
+    the last call with the same path, computing only the new rows (and the
+    last few saved rows of statistics that look ahead, see 
+    statistics_lookahead).
+    Everything is recomputed when there is no saved state, when it was made
+    with other arguments, or when any of the saved history or a population
+    has changed (e.g. JHU revised earlier counts or the lookup table).
+    Input: path, the directory to keep the state in
+           rowdf must be sorted by group and then by date
+           the other arguments are as for gen_statistics (workers only 
+           applies to a full recompute)
+    Side effect: Mutates rowdf and saves the new state to path
+    """
+    if statistics is None:
+        statistics = STATISTICS
+    # compare settings the way they come back from the manifest
+    settings = json.loads(json.dumps({'groupby': groupby, 'no_trends': no_trends, 
+                                      'statistics': statistics, 
+                                      'serial_interval': SERIAL_INTERVAL}))
+    segments = kernels.Segments(rowdf, groupby)
+    if segments.order is not None:
+        raise ValueError('update_statistics needs rowdf sorted by group')
+    state = load_statistics_state(path)
+    saved = saved_lengths(rowdf, segments, state, settings) if state is not None else None
+
+    if saved is None:
+        before = set(rowdf.columns)
+        gen_statistics(rowdf, groupby, no_trends, statistics, workers)
+        columns = [c for c in rowdf.columns if c not in before]
+    else:
+        columns = state['columns']
+        lengths = segments.lengths
+        added = lengths - saved
+        print(f'Computing statistics for {added.sum()} new rows')
+        # the last saved rows change too if a statistic looks ahead
+        redo = np.minimum(saved, statistics_lookahead(statistics))
+        # enough of each group's history to compute the new rows
+        keep = np.minimum(saved, statistics_lookback(statistics) + redo)
+        tail = rowdf.iloc[kernels.ranges(segments.starts + saved - keep, keep + added)]
+        tail = tail.reset_index(drop=True)
+        # (too few rows to be worth splitting among workers)
+        gen_statistics(tail, groupby, no_trends, statistics)
+
+        tail_starts = np.concatenate([[0], np.cumsum(keep + added)[:-1]])
+        saved_starts = np.concatenate([[0], np.cumsum(saved)[:-1]])
+        (old_rows, new_rows) = (kernels.ranges(segments.starts, saved - redo),
+                                kernels.ranges(segments.starts + saved - redo, redo + added))
+        old_saved_rows = kernels.ranges(saved_starts, saved - redo)
+        new_tail_rows = kernels.ranges(tail_starts + keep - redo, redo + added)
+        for (k, column) in enumerate(columns):
+            values = np.empty(len(rowdf))
+            values[old_rows] = state['stats'][old_saved_rows, k]
+            values[new_rows] = tail[column].to_numpy(dtype=np.float64)[new_tail_rows]
+            rowdf[column] = values
+
+    save_statistics_state(path, rowdf, segments, settings, columns)
@@ -10,9 +10,19 @@
 
 import pandas as pd
 import numpy as np
-from collections import defaultdict
-import tqdm
 import re
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import time
+import argparse
+
+try:
+    import pyarrow # (pip install pyarrow) only needed for the on-disk cache
+except ImportError:
+    pyarrow = None
 
 ###########################################################################
 # Directory setup
@@ -22,13 +32,22 @@ def setup_dirs(base_loc='.'):
     global jhu_loc
     global series_loc
     global confirmed_csv
+    global lookup_csv
+    global regions_csv
+    global merged_csv
+    global cache_loc
 
     ## where population data is stored
     population_loc = f'{base_loc}/data/resources'
+    regions_csv = f'{population_loc}/regions.csv'
+    merged_csv = f'{population_loc}/merged-counties.csv'
     ## root directory of the JHU data repository
     jhu_loc = f'{base_loc}/data/jhu/'
     series_loc = f'{jhu_loc}/csse_covid_19_data/csse_covid_19_time_series'
     confirmed_csv = f'{series_loc}/time_series_covid19_confirmed_US.csv'
+    lookup_csv = f'{jhu_loc}/csse_covid_19_data/UID_ISO_FIPS_LookUp_Table.csv'
+    ## where annotated/unrolled dataframes are cached between runs
+    cache_loc = f'{base_loc}/data/cache'
 setup_dirs()
 
 ###########################################################################
@@ -38,8 +57,7 @@ def clip_at_zero_series(df):
     Purpose: Remove all days before the first confirmed case
     Input: Requires the dataframe in the original format with columns of dates
     """
-    rgx = re.compile(r'\d+/\d+/\d+')
-    date_cols = [c for c in df.columns if rgx.search(c)]
+    (date_cols, _) = date_columns(df)
     drops = []
     for c in date_cols:
         sm = df[c].sum()
@@ -59,11 +77,10 @@ def load_jhu_population_data():
     Returns: a dataframe with the following columns: 
         Admin2, Province_State, Population, Region
     """
-    popcsv = f'{jhu_loc}/csse_covid_19_data/UID_ISO_FIPS_LookUp_Table.csv'
-    df = pd.read_csv(popcsv, dtype={"FIPS": str})
+    df = pd.read_csv(lookup_csv, dtype={"FIPS": str})
     df = df[df.Country_Region == "US"]
     df = fix_yakutat_alaska(df)
-    region_df = pd.read_csv(f'{population_loc}/regions.csv')
+    region_df = pd.read_csv(regions_csv)
     # Rename the county for 'New York City' to be 'New York'
     #df.loc[(df.Province_State=='New York') & \
     #    (df.Admin2=="New York City"), "Admin2"] = "New York"
@@ -86,7 +103,7 @@ def fix_yakutat_alaska(df):
     return df
 
 
-def read_jhu_data():
+def read_jhu_data(clip_date=None, states=None):
     """ 
     Purpose: Load the time-series case counts data set.
     Returns: a dataframe with the following columns:
@@ -102,34 +119,68 @@ def read_jhu_data():
       - Long_         : Longitude
       - Combined_Key  : pretty printed string for province/state, country
       - 1/22/20...    : one column for each day starting January 22, 2020
+    Input: clip_date, if given, only the dates from clip_date on are parsed
+           states, if given, only the rows for these states are kept
     """    
-    df = pd.read_csv(confirmed_csv, dtype={"FIPS": str})
+    usecols = None
+    if clip_date is not None:
+        header = pd.read_csv(confirmed_csv, nrows=0)
+        (date_cols, date_dts) = date_columns(header)
+        early = set(c for (c, dt) in zip(date_cols, date_dts) if dt < pd.Timestamp(clip_date))
+        usecols = [c for c in header.columns if c not in early]
+    df = pd.read_csv(confirmed_csv, dtype={"FIPS": str}, usecols=usecols)
+    if states is not None:
+        df = df[df.Province_State.isin(states)].reset_index(drop=True)
     # places with no county name get filled with the state name
     df['Admin2'].fillna(df.Province_State,inplace=True)
     return df
 
 ###########################################################################
 
+LOCATION_KEY = ['Province_State', 'Admin2']
+
+def location_index(df, columns):
+    """
+    Purpose: Build a lookup table of the given columns keyed on 
+    (Province_State, Admin2). If a location is listed more than once,
+    the last entry wins. Rows without a county name (e.g. the state-wide
+    population rows) are left out and never match.
+    Returns: a dataframe indexed by (Province_State, Admin2)
+    """
+    df = df.dropna(subset=LOCATION_KEY).drop_duplicates(LOCATION_KEY, keep='last')
+    return df.set_index(LOCATION_KEY)[columns]
+
+def annotate_locations(df, index):
+    """
+    Purpose: Annotate a dataframe with every column of a location_index in a
+    single keyed join. Works for the wide jhudf (one row per location) and 
+    for the unrolled rowdf (one row per location/date) alike, so annotations
+    such as regions can be replaced after unrolling.
+    Locations that are not in the index are annotated with NaN.
+    Side effect: Mutates the df dataframe to add (or replace) the columns
+    """
+    rows = index.index.get_indexer(pd.MultiIndex.from_frame(df[LOCATION_KEY]))
+    found = rows >= 0
+    for col in index.columns:
+        values = index[col].to_numpy()
+        # (rows of -1 index nothing in an empty table, e.g. after filtering by state)
+        values = values[np.where(found, rows, 0)] if len(values) else np.full(len(rows), np.nan)
+        df[col] = pd.Series(values, index=df.index).where(found)
+
 def annotate_regions(df, region_df):
     """
     Purpose: Annotate the  confirmed case dataframe with the region, as available.
       -- As of Dec 2020, regions exist for PA, NY, MN, CA, GA.
     Side effect: Mutates the df dataframe to add a 'Region' column
     """
-    region_map = defaultdict(lambda: np.nan)
-    for d in region_df.to_dict('records'):
-        region_map[(d['Province_State'], d['Admin2'])] = d['Region']
-    df['Region'] = df[['Province_State', 'Admin2']].apply(lambda x: region_map[(x[0], x[1])], axis=1)
+    annotate_locations(df, location_index(region_df, ['Region']))
 
 def annotate_populations(df, pop_df):
     """ 
     Purpose: Annotate the confirmed case dataframe with population information.
     Side effect: Mutates the df dataframe to add a 'Population' column
     """
-    pop_map = defaultdict(lambda: np.nan)
-    for d in pop_df.to_dict('records'):
-        pop_map[d['Province_State'], d['Admin2']] = d['Population']
-    df['Population'] = df.loc[:,['Province_State','Admin2']].apply(lambda x: pop_map[x[0], x[1]], axis=1)
+    annotate_locations(df, location_index(pop_df, ['Population']))
 
 ###########################################################################
 
@@ -159,8 +210,7 @@ def drop_zero_counties(df):
     Returns: a new df with these counties removed.
     """
     # find which columns are dates and merge them
-    rgx = re.compile(r'\d+/\d+/\d+')
-    date_cols = [c for c in df.columns if rgx.search(c)]
+    (date_cols, _) = date_columns(df)
     filtered = df[(df[date_cols].sum(axis=1)>0) | \
                 (df['Admin2'].isnull()) | \
                 (df['Province_State']=='American Samoa')]
@@ -168,16 +218,49 @@ def drop_zero_counties(df):
     return filtered
 
 ###########################################################################
+def date_columns(df):
+    """
+    Purpose: Find the date columns (e.g. '1/22/20') of a JHU dataframe
+    Returns: (list of column names, DatetimeIndex of the matching dates)
+    """
+    rgx = re.compile(r'\d+/\d+/\d+')
+    date_cols = [c for c in df.columns if rgx.search(c)]
+    date_dts = pd.to_datetime(date_cols, format='%m/%d/%y')
+    return (date_cols, date_dts)
+
 def unroll_dates(df):
     """
     Purpose: turn columns of dates into individual rows
     Input: a dataframe read from the JHU dataset already annotated with 
            population and region (if desired)
-    Returns: a new dataframe with one row for each date/location
+    Returns: a new dataframe with one row for each date/location, sorted by
+             Province_State, Admin2 and Last_Update
+    Note: the date block is reshaped in one step: the location columns are
+          repeated once per date and the (location x date) matrix of counts
+          is flattened row-major, so each location's dates stay contiguous.
     """
-    rgx = re.compile(r'\d+/\d+/\d+')
-    date_cols = [c for c in df.columns if rgx.search(c)]
-    date_dts = [pd.to_datetime(d) for d in date_cols]
+    (date_cols, date_dts) = date_columns(df)
+    first_date = df.columns.get_loc(date_cols[0])
+    meta_cols = [c for c in df.columns if c not in set(date_cols)]
+
+    df = df.sort_values(['Province_State', 'Admin2'], kind='mergesort')
+    ndates = len(date_cols)
+
+    rows = np.repeat(np.arange(len(df)), ndates)
+    rowdf = df[meta_cols].iloc[rows].reset_index(drop=True)
+    rowdf.insert(first_date, 'Confirmed', df[date_cols].to_numpy().ravel())
+    rowdf['Last_Update'] = np.tile(date_dts.values, len(df))
+
+    return rowdf
+
+def unroll_dates_loop(df):
+    """
+    Purpose: The original (slow) version of unroll_dates that builds one 
+    dataframe per date and concatenates them. Kept for benchmarking.
+    Returns: a new dataframe with one row for each date/location, ordered
+             by date and then by location.
+    """
+    (date_cols, date_dts) = date_columns(df)
     date_cols_set = set(date_cols)
 
     all_dfs = []
@@ -193,39 +276,91 @@ def unroll_dates(df):
 
     return df
 
+def benchmark_unroll(jhudf, repeat=3):
+    """
+    Purpose: Compare the time taken by unroll_dates and unroll_dates_loop
+    on the same (annotated) JHU dataframe and check that they agree.
+    Returns: (best loop time, best vectorized time) in seconds
+    """
+    def best_time(fn):
+        times = []
+        for _ in range(repeat):
+            s = time.time()
+            out = fn(jhudf)
+            times.append(time.time() - s)
+        return (min(times), out)
+
+    (t_loop, loopdf) = best_time(unroll_dates_loop)
+    (t_vec, vecdf) = best_time(unroll_dates)
+
+    loopdf.sort_values(['Province_State','Admin2','Last_Update'], inplace=True)
+    loopdf.reset_index(drop=True, inplace=True)
+    pd.testing.assert_frame_equal(loopdf, vecdf)
+
+    (ncounties, ndates) = (len(jhudf), len(date_columns(jhudf)[0]))
+    print(f'unroll {ncounties} locations x {ndates} dates')
+    print(f'  loop:       {t_loop:8.3f}s')
+    print(f'  vectorized: {t_vec:8.3f}s ({t_loop/t_vec:.1f}x)')
+    return (t_loop, t_vec)
+
 
 ###########################################################################
 
-def fix_merged_counties(rowdf):
+def load_merged_counties():
+    """
+    Purpose: Read the counties that JHU reports together as a single "county"
+    Returns: a dataframe with the following columns:
+      - Province_State: the state
+      - Merged        : the name JHU uses for the merged county
+      - Admin2        : one of the counties that it is made up of
+      - Rename        : if given, the name to use for the merged county itself
+    """
+    return pd.read_csv(merged_csv, dtype=str)
+
+def fix_merged_counties(rowdf, merged_df=None):
     """
     Purpose: Copy Confirmed cases and Population statistics over
-    to all of the counties that are part of a merged county.
+    to all of the counties that are part of a merged county, and rename 
+    merged counties that have a Rename (e.g. 'Bristol Bay plus Lake and
+    Peninsula' becomes 'Lake and Peninsula').
+    Input: merged_df, as returned by load_merged_counties (the default)
     Note: This should be done only for mapping purposes and should be done
-    before computing statistics.
-    """
-    regions = {('Southeast Utah', 'Utah'): ['Carbon', 'Emery', 'Grand', 'Sevier'],
-        ('Central Utah', 'Utah'): ['Juab', 'Millard', 'Piute', 'Sanpete', 'Wayne'],
-        ('Bear River', 'Utah'): ['Box Elder', 'Cache', 'Rich'],
-        ('Southwest Utah', 'Utah'): ['Beaver', 'Garfield', 'Iron', 'Kane', 'Washington'],
-        ('TriCounty', 'Utah'): ['Daggett', 'Duchesne', 'Uintah'],
-        ('Weber-Morgan', 'Utah'): ['Weber', 'Morgan'],
-        ('Dukes and Nantucket', 'Massachusetts'): ['Dukes', 'Nantucket'],
-        ('Bristol Bay plus Lake and Peninsula', 'Alaska'): ['Bristol Bay'],
-        }
-
+    before computing statistics. Member counties that aren't in rowdf
+    (e.g. because drop_zero_counties removed them) are skipped.
+    Side effect: Mutates rowdf
+    """
+    if merged_df is None:
+        merged_df = load_merged_counties()
     columns = ['Confirmed', 'Population']
 
-    for ((src, state), destinations) in tqdm.tqdm(regions.items()):
-        for dst in destinations:
-            for column in columns:
-                rowdf.loc[(rowdf.Province_State==state)&(rowdf.Admin2==dst), column] = \
-                    rowdf[rowdf.Admin2==src][column].to_list()
-
-    # rename 'Bristol Bay plus Lake and Peninsula' to just 'Lake and Peninsula'
-    rowdf.loc[(rowdf.Province_State=='Alaska')&(rowdf.Admin2=='Bristol Bay plus Lake and Peninsula'), \
-        'Admin2'] = 'Lake and Peninsula'
-    rowdf.loc[(rowdf.Province_State=='Alaska')&(rowdf.Admin2=='Bristol Bay plus Lake and Peninsula'), \
-        'Combined_Key'] = 'Lake and Peninsula, Alaska, US'
+    # the rows of the merged counties and their members, as (state, county, date)
+    names = set(merged_df.Merged) | set(merged_df.Admin2)
+    mask = (rowdf.Province_State.isin(set(merged_df.Province_State)) & rowdf.Admin2.isin(names)).to_numpy()
+    rows = rowdf.loc[mask, ['Province_State', 'Admin2', 'Last_Update']]
+    rows = rows.astype({'Province_State': object, 'Admin2': object})
+    rows['row'] = np.flatnonzero(mask)
+
+    # pair each member row with the merged row for the same date
+    pairs = rows.merge(merged_df[['Province_State', 'Admin2', 'Merged']], on=['Province_State', 'Admin2'])
+    pairs = pairs.merge(rows.rename(columns={'Admin2': 'Merged', 'row': 'src'}), 
+                        on=['Province_State', 'Merged', 'Last_Update'])
+    (dst, src) = (pairs['row'].to_numpy(), pairs['src'].to_numpy())
+    for column in columns:
+        values = rowdf[column].to_numpy().copy()
+        values[dst] = values[src]
+        rowdf[column] = values
+
+    # rename the merged counties themselves
+    renames = merged_df.dropna(subset=['Rename']).drop_duplicates(['Province_State', 'Merged'])
+    renamed = rows.merge(renames.rename(columns={'Admin2': 'Member', 'Merged': 'Admin2'}), 
+                         on=['Province_State', 'Admin2'])
+    if len(renamed):
+        keys = renamed.Rename + ', ' + renamed.Province_State + ', US'
+        for (column, values) in [('Admin2', renamed.Rename), ('Combined_Key', keys)]:
+            for value in set(values):
+                rowdf[column] = add_category(rowdf[column], value)
+            rowdf.iloc[renamed['row'].to_numpy(), rowdf.columns.get_loc(column)] = values.to_numpy()
+
 ###########################################################################
 def fix_FIPS(df):
     """
@@ -236,26 +371,420 @@ def fix_FIPS(df):
     df['FIPS'] = df['FIPS'].apply(fn)
 
 ###########################################################################
-def read_annotated_jhu_data(omit_zero_counties=True, unmerge_counties=False):
+def read_annotated_jhu_data(omit_zero_counties=True, unmerge_counties=False, use_cache=True,
+                            compact=False, states=None, clip_date=None, incremental=True):
     """
     Purpose: Read data sources from JHU and covidtracking.com
+    Input: use_cache, if True (and pyarrow is installed), reuse the annotated
+           and unrolled dataframes from a previous run as long as none of the
+           source CSVs have changed since then.
+           incremental, if True (and use_cache), when the only change is
+           that new days were added to the JHU data, parse just those days
+           and append them to the previous cache (see update_cache).
+           compact, if True, drop unused metadata columns and store the
+           remaining columns with smaller dtypes (see compact_frame).
+           states, if given, a list of the states to keep
+           clip_date, if given, the earliest date to keep
+           Without a cache, other states and dates are never unrolled (or,
+           for dates, even parsed). Only unfiltered reads are cached.
+    Returns: (popdf, jhudf, rowdf)
     """    
+    options = {'omit': omit_zero_counties, 'unmerge': unmerge_counties, 'compact': compact}
+    if use_cache:
+        cached = load_cache(options)
+        if cached is None and incremental:
+            cached = update_cache(options)
+        if cached is not None:
+            (popdf, jhudf, rowdf) = select_jhu_data(cached, states, clip_date)
+            if compact: memory_footprint(rowdf, 'rowdf')
+            return (popdf, jhudf, rowdf)
+
+    (popdf, jhudf) = read_annotated_jhu_wide(omit_zero_counties, use_cache=False, compact=compact,
+                                             states=states, clip_date=clip_date)
+    rowdf = unroll_dates(jhudf)
+    if unmerge_counties:
+        fix_merged_counties(rowdf)
+        # renaming merged counties can move them within the sort order
+        rowdf.sort_values(['Province_State','Admin2','Last_Update'], inplace=True)
+        rowdf.reset_index(drop=True,inplace=True)
+
+    if use_cache and states is None and clip_date is None:
+        save_cache((popdf, jhudf, rowdf), options)
+    if compact: memory_footprint(rowdf, 'rowdf')
+
+    return (popdf, jhudf, rowdf)
+
+def read_annotated_jhu_wide(omit_zero_counties=True, use_cache=True, compact=False,
+                            states=None, clip_date=None, incremental=True):
+    """
+    Purpose: Read and annotate the JHU data without unrolling it. This is
+    all that is needed for state and national totals (see cube.CaseCube).
+    Input: as for read_annotated_jhu_data. With use_cache (and pyarrow), 
+           the whole ingest is read through a cache of just popdf and 
+           jhudf and then filtered, so that a miss writes the cache for the
+           next run (or, with incremental, appends the new days to the last
+           one).
+    Returns: (popdf, jhudf)
+    """
+    if use_cache and pyarrow is not None:
+        options = {'omit': omit_zero_counties, 'unmerge': False, 'compact': compact, 'wide': True}
+        cached = load_cache(options)
+        if cached is None and incremental:
+            cached = update_cache(options)
+        if cached is None:
+            cached = read_annotated_jhu_wide(omit_zero_counties, use_cache=False, compact=compact)
+            save_cache(cached, options)
+        (popdf, jhudf, _) = select_jhu_data(cached + (None,), states, clip_date)
+        return (popdf, jhudf)
+
     popdf = load_jhu_population_data()
-    jhudf = read_jhu_data()
+    jhudf = read_jhu_data(clip_date=clip_date, states=states)
     fix_FIPS(jhudf)
     annotate_regions(jhudf, popdf)
     annotate_populations(jhudf, popdf)
     if omit_zero_counties:
         jhudf = drop_zero_counties(jhudf)
-    rowdf = unroll_dates(jhudf)
-    if unmerge_counties:
-        fix_merged_counties(rowdf)
-
-    rowdf.sort_values(['Province_State','Admin2','Last_Update'], inplace=True)
-    rowdf.reset_index(drop=True,inplace=True)
+    if compact:
+        jhudf = compact_frame(jhudf)
+    return (popdf, jhudf)
 
+def select_jhu_data(dfs, states=None, clip_date=None):
+    """
+    Purpose: Keep only the given states and the dates from clip_date on
+    Input: (popdf, jhudf, rowdf), where rowdf may be None
+    Returns: a new (popdf, jhudf, rowdf)
+    """
+    (popdf, jhudf, rowdf) = dfs
+    if states is not None:
+        jhudf = jhudf[jhudf.Province_State.isin(states)].reset_index(drop=True)
+        if rowdf is not None:
+            rowdf = rowdf[rowdf.Province_State.isin(states)].reset_index(drop=True)
+        # match the categories of a compact frame read with the same filter
+        for df in [jhudf, rowdf]:
+            for col in (df.columns[df.dtypes == 'category'] if df is not None else []):
+                df[col] = df[col].cat.remove_unused_categories()
+    if clip_date is not None:
+        clip_date = pd.Timestamp(clip_date)
+        (date_cols, date_dts) = date_columns(jhudf)
+        jhudf = jhudf.drop(columns=[c for (c, dt) in zip(date_cols, date_dts) if dt < clip_date])
+        if rowdf is not None:
+            rowdf = rowdf[rowdf.Last_Update >= clip_date].reset_index(drop=True)
     return (popdf, jhudf, rowdf)
 
+###########################################################################
+# Compact representation
+#
+# Nothing downstream reads the UID/ISO codes or coordinates, the location
+# strings repeat on every row of the unrolled data and the case counts fit 
+# in 32 bits. Population stays float64 so that state and national sums of
+# it are exact.
+
+COMPACT_DROP = ['UID', 'iso2', 'iso3', 'code3', 'Country_Region', 'Lat', 'Long_']
+COMPACT_CATEGORIES = ['FIPS', 'Admin2', 'Province_State', 'Combined_Key', 'Region']
+
+def compact_frame(df):
+    """
+    Purpose: Shrink a JHU dataframe (wide or unrolled) by dropping the 
+    COMPACT_DROP columns, turning the COMPACT_CATEGORIES columns into
+    categoricals and storing the case counts as int32.
+    Returns: a new dataframe
+    """
+    df = df.drop(columns=[c for c in COMPACT_DROP if c in df])
+    for col in COMPACT_CATEGORIES:
+        if col in df:
+            df[col] = df[col].astype('category')
+    (count_cols, _) = date_columns(df)
+    if 'Confirmed' in df:
+        count_cols.append('Confirmed')
+    if all(df[c].dtype.kind == 'i' for c in count_cols):
+        df[count_cols] = df[count_cols].astype(np.int32)
+    return df
+
+def memory_footprint(df, label=None):
+    """
+    Purpose: Measure (and optionally print) the memory used by a dataframe,
+    including the strings held in object columns.
+    Returns: the size in bytes
+    """
+    nbytes = df.memory_usage(deep=True).sum()
+    if label:
+        print(f'{label}: {len(df)} rows, {nbytes/2**20:.1f} MB')
+    return nbytes
+
+def add_category(s, value):
+    """
+    Purpose: Make sure that value can be stored in s, keeping the categories
+    of a categorical series in sorted order.
+    Returns: s, or a new series with the extra category
+    """
+    if isinstance(s.dtype, pd.CategoricalDtype) and value not in s.cat.categories:
+        s = s.cat.set_categories(sorted(set(s.cat.categories) | {value}))
+    return s
+
+###########################################################################
+# On-disk cache of the annotated data
+#
+# The cache lives in {cache_loc}/{tag}-{digest}/ and holds one Feather file
+# for each of popdf, jhudf and rowdf. The digest covers the contents of
+# every source file, so any change to the JHU data or the resource files results
+# in a cache miss.
+#
+# JHU updates the time series once a day by adding a date column to the
+# right of every line. A manifest records the digest of each source file
+# and which CSV line every cached location came from, so that on a miss
+# caused only by appended days, update_cache can parse, annotate and unroll
+# just the new days and append them to the previous cache. Anything else
+# (revised historical counts, added or reordered locations, new regions or
+# populations) results in a full rebuild.
+#
+# read_annotated_jhu_wide keeps its own cache (the 'wide' option) of just
+# popdf and jhudf, so that it never reads, or unrolls, a rowdf it won't use.
+
+CACHE_VERSION = 2
+CACHE_FRAMES = ['popdf', 'jhudf', 'rowdf']
+CACHE_SOURCES = ['confirmed', 'lookup', 'regions', 'merged']
+
+def hash_file(path):
+    """ The SHA-256 digest of a file, as a hex string """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def source_digests():
+    """ The digests of the source CSVs, keyed by the names in CACHE_SOURCES """
+    paths = [confirmed_csv, lookup_csv, regions_csv, merged_csv]
+    return {name: hash_file(path) for (name, path) in zip(CACHE_SOURCES, paths)}
+
+def hash_sources(options, digests=None):
+    """
+    Purpose: Compute a digest of the source CSVs (and the options used to
+    process them) that identifies a cached ingest.
+    Input: digests, from source_digests() if they are already known
+    Returns: a hex string
+    """
+    if digests is None:
+        digests = source_digests()
+    h = hashlib.sha256()
+    h.update(repr((CACHE_VERSION, sorted(options.items()))).encode())
+    for name in CACHE_SOURCES:
+        h.update(digests[name].encode())
+    return h.hexdigest()
+
+def cache_tag(options):
+    """ The part of the cache directory name that depends on the options """
+    return 'jhu-' + '-'.join(f'{name}{int(value)}' for (name, value) in options.items())
+
+def cache_frames(options):
+    """ The names of the dataframes cached with these options """
+    return CACHE_FRAMES[:2] if options.get('wide') else CACHE_FRAMES
+
+def tagged_dirs(tag):
+    """ The cache directories (finished or not) named {tag}-{digest} """
+    return [p for p in pathlib.Path(cache_loc).glob(f'{tag}-*') if '-' not in p.name[len(tag)+1:]]
+
+def cache_dir(options, digests=None):
+    """ The cache directory for the current source files and options """
+    tag = cache_tag(options)
+    digest = hash_sources(options, digests)
+    return pathlib.Path(cache_loc, f'{tag}-{digest[:16]}')
+
+def previous_cache(options):
+    """ The most recently written cache directory for these options, or None """
+    tag = cache_tag(options)
+    paths = [p for p in tagged_dirs(tag)
+             if not p.name.endswith('.tmp') and p.joinpath('manifest.json').exists()]
+    return max(paths, key=lambda p: p.stat().st_mtime) if paths else None
+
+def read_cache_frames(path, frames=CACHE_FRAMES):
+    """
+    Purpose: Read the dataframes stored in a cache directory
+    Input: frames, the names of the dataframes to read (see cache_frames)
+    Returns: a tuple of them, e.g. (popdf, jhudf, rowdf), or None if any of
+             them is missing
+    """
+    if not all(path.joinpath(f'{name}.feather').exists() for name in frames):
+        return None
+    dfs = [pd.read_feather(path.joinpath(f'{name}.feather')) for name in frames]
+    for df in dfs:
+        # feather stores missing strings as None; restore the NaN from read_csv
+        for col in df.columns[df.dtypes == object]:
+            df[col] = df[col].where(df[col].notnull(), np.nan)
+    return tuple(dfs)
+
+def load_cache(options):
+    """
+    Purpose: Load a previously cached (popdf, jhudf, rowdf), or (popdf, 
+    jhudf) for the wide option
+    Returns: the tuple of dataframes, or None if there is no valid cache
+    """
+    if pyarrow is None:
+        return None
+    return read_cache_frames(cache_dir(options), cache_frames(options))
+
+def source_rows(jhudf):
+    """
+    Purpose: Find the line of confirmed_csv that each row of jhudf came from
+    Returns: (array of row numbers, number of data rows in the CSV, number of
+             date columns in the CSV), or None if the rows can't be matched
+    """
+    csvdf = pd.read_csv(confirmed_csv, usecols=LOCATION_KEY)
+    csvdf['Admin2'] = csvdf['Admin2'].fillna(csvdf.Province_State)
+    index = pd.MultiIndex.from_frame(csvdf[LOCATION_KEY])
+    if not index.is_unique:
+        return None
+    rows = index.get_indexer(pd.MultiIndex.from_frame(jhudf[LOCATION_KEY].astype(object)))
+    if (rows < 0).any():
+        return None
+    (date_cols, _) = date_columns(pd.read_csv(confirmed_csv, nrows=0))
+    return (rows, len(csvdf), len(date_cols))
+
+def save_cache(dfs, options, digests=None, rows=None):
+    """
+    Purpose: Store (popdf, jhudf, rowdf), or (popdf, jhudf) for the wide
+    option, so the next run can skip the ingest. Stale caches made with the
+    same options are removed.
+    Input: digests, from source_digests() if they are already known
+           rows, from source_rows(jhudf) if they are already known
+    Side effect: Also writes the manifest that update_cache needs. 
+    """
+    if pyarrow is None:
+        return
+    if digests is None:
+        digests = source_digests()
+    path = cache_dir(options, digests)
+    # write to a private directory first: p_update.sh runs several of these at once
+    tmp = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    tmp.mkdir(parents=True, exist_ok=True)
+    for name, df in zip(cache_frames(options), dfs):
+        df.to_feather(tmp.joinpath(f'{name}.feather'))
+
+    if rows is None:
+        rows = source_rows(dfs[1])
+    if rows is not None:
+        np.save(tmp.joinpath('rows.npy'), rows[0])
+        manifest = {'version': CACHE_VERSION, 'digests': digests, 
+                    'nrows': rows[1], 'ndates': rows[2]}
+        with open(tmp.joinpath('manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=1)
+
+    tag = cache_tag(options)
+    for old in tagged_dirs(tag):
+        if old != path and not old.name.endswith('.tmp'):
+            shutil.rmtree(old, ignore_errors=True)
+    try:
+        tmp.rename(path)
+    except OSError: # another process got there first
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def read_appended_dates(manifest):
+    """
+    Purpose: Check whether confirmed_csv is the file described by the manifest
+    with one or more dates added to the end of each line and, if so, parse
+    only the new dates. Lines are split from the right, so the location
+    columns (some of which contain quoted commas) are never parsed.
+    Returns: (list of the new date columns, int64 array with a row for every
+             CSV row and a column for every new date), or None if the file 
+             changed in any other way
+    """
+    with open(confirmed_csv, 'rb') as f:
+        lines = f.read().splitlines(keepends=True)
+    (date_cols, _) = date_columns(pd.read_csv(confirmed_csv, nrows=0))
+    nnew = len(date_cols) - manifest['ndates']
+    if nnew <= 0 or len(lines) != manifest['nrows'] + 1:
+        return None
+
+    # the digest of the file with the new dates cut off each line
+    h = hashlib.sha256()
+    counts = np.empty((len(lines) - 1, nnew), dtype=np.int64)
+    for (i, line) in enumerate(lines):
+        body = line.rstrip(b'\r\n')
+        fields = body.rsplit(b',', nnew)
+        if len(fields) != nnew + 1:
+            return None
+        h.update(fields[0])
+        h.update(line[len(body):])
+        if i > 0:
+            try:
+                counts[i - 1] = [int(x) for x in fields[1:]]
+            except ValueError: # a missing value, let read_csv deal with it
+                return None
+    if h.hexdigest() != manifest['digests']['confirmed']:
+        return None
+    return (date_cols[-nnew:], counts)
+
+def update_cache(options):
+    """
+    Purpose: Bring the previous cache made with these options up to date when
+    the only change to the sources is that JHU appended one or more days.
+    Only the new days are parsed and unrolled; they are added to the cached
+    jhudf and rowdf (unless it is a wide cache, without a rowdf), and the 
+    result is saved as the cache for the current sources.
+    Returns: the cached tuple of dataframes (see load_cache), or None if a
+             full rebuild is needed
+    """
+    if pyarrow is None:
+        return None
+    prev = previous_cache(options)
+    if prev is None:
+        return None
+    with open(prev.joinpath('manifest.json')) as f:
+        manifest = json.load(f)
+    if manifest['version'] != CACHE_VERSION:
+        return None
+    digests = source_digests()
+    if any(digests[name] != manifest['digests'][name] for name in CACHE_SOURCES[1:]):
+        return None
+    appended = read_appended_dates(manifest)
+    if appended is None:
+        return None
+    (new_cols, counts) = appended
+    cached = read_cache_frames(prev, cache_frames(options))
+    if cached is None:
+        return None
+    (popdf, jhudf, rowdf) = cached if len(cached) == 3 else cached + (None,)
+    rows = np.load(prev.joinpath('rows.npy'))
+
+    (date_cols, _) = date_columns(jhudf)
+    if options['omit']:
+        # drop_zero_counties has to make the same choices with the new days
+        dropped = np.ones(len(counts), dtype=bool)
+        dropped[rows] = False
+        totals = jhudf[date_cols].sum(axis=1).to_numpy() + counts[rows].sum(axis=1)
+        exempt = (jhudf['Admin2'].isnull() | (jhudf['Province_State']=='American Samoa')).to_numpy()
+        if (counts[dropped] != 0).any() or ((totals <= 0) & ~exempt).any():
+            return None
+
+    ndates = len(date_cols)
+    if rowdf is not None and len(rowdf) != len(jhudf) * ndates:
+        return None
+    print(f'Appending {len(new_cols)} new day(s) to the cached JHU data')
+
+    # add the new date columns after the existing ones
+    last = jhudf.columns.get_loc(date_cols[-1]) + 1
+    newdf = pd.DataFrame(counts[rows].astype(jhudf[date_cols[-1]].dtype), columns=new_cols)
+    jhudf = pd.concat([jhudf.iloc[:, :last], newdf, jhudf.iloc[:, last:]], axis=1)
+
+    if rowdf is not None:
+        # unroll just the new days, then slot them in after each location's old days
+        newrowdf = unroll_dates(jhudf.drop(columns=date_cols))
+        if options['unmerge']:
+            fix_merged_counties(newrowdf)
+            newrowdf.sort_values(['Province_State','Admin2','Last_Update'], inplace=True)
+        (nloc, nnew) = (len(jhudf), len(new_cols))
+        stride = ndates + nnew
+        order = np.empty(nloc * stride, dtype=np.int64)
+        order[(np.arange(nloc)[:, np.newaxis] * stride + np.arange(ndates)).ravel()] = \
+            np.arange(nloc * ndates)
+        order[(np.arange(nloc)[:, np.newaxis] * stride + ndates + np.arange(nnew)).ravel()] = \
+            nloc * ndates + np.arange(nloc * nnew)
+        rowdf = pd.concat([rowdf, newrowdf], ignore_index=True).iloc[order].reset_index(drop=True)
+
+    dfs = (popdf, jhudf, rowdf)[:len(cached)]
+    save_cache(dfs, options, digests, (rows, manifest['nrows'], manifest['ndates'] + len(new_cols)))
+    return dfs
+
 ###########################################################################
 def fix_counties(jhudf):
     """
@@ -268,4 +797,11 @@ def fix_counties(jhudf):
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Read and annotate the JHU data')
+    parser.add_argument('--benchmark', action='store_true', 
+                        help='Time unroll_dates against the original loop')
+    args = parser.parse_args()
+
     (popdf, jhudf, rowdf) = read_annotated_jhu_data()
+    if args.benchmark:
+        benchmark_unroll(jhudf)
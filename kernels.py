@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Segment-aware kernels for per-location time series.
+#
+# The unrolled dataframes hold one contiguous block of rows (a segment) for
+# each location, sorted by date. Instead of calling a Python function once
+# per location with groupby().transform(), these kernels run over the whole
+# column at once and use the segment boundaries to keep windows from
+# reaching into the previous location:
+# - diff                  : groupby().diff(periods)
+# - rolling_sum           : groupby().rolling(window, min_periods).sum()
+# - rolling_mean          : groupby().rolling(window, min_periods).mean()
+# - rolling_count_positive: number of values > 0 in each window
+# - rolling_slope         : least-squares slope over each window
+# - rolling_filter        : fixed weighted sum of each full window
+# - rolling_sum_every     : sum of every {step}th value, e.g. the same weekday
+# - centered_mean         : mean of a window centered on each row
+# - lagged_sum            : weighted sum of the values on earlier rows, e.g.
+#                           a convolution with a serial-interval distribution
+#
+# Window sums are differences of running sums (see RunningSums), so they are
+# exact (and match pandas) for integer-valued data such as case counts, and
+# any number of windows over the same column share one set of running sums.
+
+import numpy as np
+
+###########################################################################
+
+class Segments(object):
+    """
+    The groups of a dataframe laid out end to end, the way
+    groupby(groupby).transform sees them:
+      - order : the row numbers in group order, or None if the groups are
+                already contiguous (rows with a missing key are left out)
+      - starts: the offset at which each group starts
+      - pos   : the position of each row within its group
+    """
+    def __init__(self, rowdf, groupby):
+        codes = rowdf.groupby(groupby, observed=True, sort=False).ngroup().to_numpy()
+        self.size = len(codes)
+        # groups are numbered in order of appearance, so sorted rows give nondecreasing codes
+        if (codes >= 0).all() and (np.diff(codes) >= 0).all():
+            self.order = None
+        else:
+            self.order = np.argsort(codes, kind='stable')
+            self.order = self.order[codes[self.order] >= 0]
+            codes = codes[self.order]
+        new = np.ones(len(codes), dtype=bool)
+        new[1:] = codes[1:] != codes[:-1]
+        self.starts = np.flatnonzero(new)
+        lengths = np.diff(np.append(self.starts, len(codes)))
+        self.pos = np.arange(len(codes)) - np.repeat(self.starts, lengths)
+
+    @classmethod
+    def regular(cls, count, length):
+        """
+        Purpose: Segments for data that is already laid out as {count} groups
+        of {length} rows each, such as the locations x days of a CaseCube
+        Returns: a Segments
+        """
+        segments = cls.__new__(cls)
+        segments.size = count * length
+        segments.order = None
+        segments.starts = np.arange(count) * length
+        segments.pos = np.tile(np.arange(length), count)
+        return segments
+
+    @classmethod
+    def from_lengths(cls, lengths):
+        """
+        Purpose: Segments for contiguous groups of the given lengths, e.g. a
+        slice of the groups of another Segments
+        Returns: a Segments
+        """
+        lengths = np.asarray(lengths)
+        segments = cls.__new__(cls)
+        segments.size = int(lengths.sum())
+        segments.order = None
+        segments.starts = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+        segments.pos = np.arange(segments.size) - np.repeat(segments.starts, lengths)
+        return segments
+
+    def __len__(self):
+        return len(self.starts)
+
+    @property
+    def lengths(self):
+        """ The number of rows in each group """
+        return np.diff(np.append(self.starts, len(self.pos)))
+
+    def gather(self, column):
+        """ The values of a column (a Series) as float64, in group order """
+        values = column.to_numpy(dtype=np.float64, na_value=np.nan)
+        return values if self.order is None else values[self.order]
+
+    def scatter(self, values):
+        """ Put values computed in group order back in row order """
+        if self.order is None:
+            return values
+        result = np.full(self.size, np.nan)
+        result[self.order] = values
+        return result
+
+###########################################################################
+
+class RunningSums(object):
+    """
+    Running sums of a column (in group order) over its segments. Every 
+    window computed from the same RunningSums shares them, so adding 
+    another window to a column costs a few array subtractions.
+      - values  : the column
+      - segments: its Segments
+    """
+    def __init__(self, values, segments):
+        self.values = values
+        self.segments = segments
+        nans = np.isnan(values)
+        self.csum = np.concatenate([[0], np.cumsum(np.where(nans, 0, values))])
+        self.cmissing = np.concatenate([[0], np.cumsum(nans)])
+        self.cweighted = None
+        self.idx = np.arange(1, len(values) + 1)
+
+    def window(self, window):
+        """
+        Purpose: Sum each trailing window of up to {window} values in a 
+        segment, skipping missing values
+        Returns: (sums, number of non-missing values, window lengths)
+        """
+        n = np.minimum(self.segments.pos + 1, window)
+        start = self.idx - n
+        sums = self.csum[self.idx] - self.csum[start]
+        missing = self.cmissing[self.idx] - self.cmissing[start]
+        return (sums, n - missing, n)
+
+    def weighted_window(self, window):
+        """ Like window, but the sums are of (position in segment * value) """
+        if self.cweighted is None:
+            weighted = np.where(np.isnan(self.values), 0, self.values) * self.segments.pos
+            self.cweighted = np.concatenate([[0], np.cumsum(weighted)])
+        n = np.minimum(self.segments.pos + 1, window)
+        return self.cweighted[self.idx] - self.cweighted[self.idx - n]
+
+def ranges(starts, lengths):
+    """
+    Purpose: Row numbers for a set of blocks of rows, e.g. the first few 
+    rows of each segment
+    Returns: the concatenation of arange(start, start + length) for each 
+             start and length
+    """
+    lengths = np.asarray(lengths)
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+    return np.repeat(np.asarray(starts) - offsets, lengths) + np.arange(lengths.sum())
+
+def running_sums(values, segments):
+    """ values as a RunningSums (values may already be one) """
+    return values if isinstance(values, RunningSums) else RunningSums(values, segments)
+
+def diff(values, segments, periods=1):
+    """
+    Purpose: The change from {periods} rows earlier in the same segment
+    Returns: an array, NaN for the first {periods} rows of each segment
+    """
+    result = np.full(len(values), np.nan)
+    result[periods:] = values[periods:] - values[:-periods]
+    result[segments.pos < periods] = np.nan
+    return result
+
+def rolling_sum(values, segments, window, min_periods=None):
+    """
+    Purpose: The sum of each trailing window of {window} values in a segment
+    Input: values, an array in group order or its RunningSums
+           min_periods, the number of non-missing values needed for a
+           result (defaults to window, as with pandas)
+    Returns: an array, NaN where there are fewer than min_periods values
+    """
+    if min_periods is None:
+        min_periods = window
+    (sums, count, _) = running_sums(values, segments).window(window)
+    return np.where(count >= max(min_periods, 1), sums, np.nan)
+
+def rolling_mean(values, segments, window, min_periods=None):
+    """
+    Purpose: The mean of each trailing window of {window} values in a segment
+    Input: values and min_periods, as for rolling_sum
+    Returns: an array, NaN where there are fewer than min_periods values
+    """
+    if min_periods is None:
+        min_periods = window
+    (sums, count, _) = running_sums(values, segments).window(window)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count >= max(min_periods, 1), sums / count, np.nan)
+
+def rolling_count_positive(values, segments, window):
+    """
+    Purpose: Count the positive values in each trailing window of {window}
+    values in a segment, i.e. what
+    rolling(window=window, min_periods=window).apply(lambda x: (x>0).sum()) gives
+    Input: values, an array in group order or its RunningSums
+    Returns: an array of counts, NaN unless the window holds {window} values
+    """
+    sums = running_sums(values, segments)
+    (_, present, _) = sums.window(window)
+    (count, _, _) = RunningSums((sums.values > 0).astype(np.float64), segments).window(window)
+    return np.where(present >= window, count, np.nan)
+
+def rolling_slope(values, segments, window):
+    """
+    Purpose: The slope of the least-squares line through each trailing window
+    of up to {window} values in a segment, i.e. what
+    rolling(window=window, min_periods=1).apply(fit) gives but in closed form:
+        slope = (n*Sxy - Sx*Sy) / (n*Sxx - Sx*Sx)
+    where x runs from 0 to n-1 within the window. Sy and Sxy come from
+    running sums of y and of (position * y); Sx and Sxx only depend on n.
+    Input: values, an array in group order or its RunningSums
+    Returns: an array of slopes (0 for a window of one value, NaN for a
+             window with a missing value)
+    """
+    sums = running_sums(values, segments)
+    (sy, present, n) = sums.window(window)
+    spy = sums.weighted_window(window)
+    # shift x so that it starts at 0 in each window
+    sxy = spy - (segments.pos - n + 1) * sy
+    sx = n * (n - 1) / 2
+    denominator = n * n * (n * n - 1) / 12
+    slope = np.divide(n * sxy - sx * sy, denominator,
+                      out=np.zeros(len(sy)), where=denominator > 0)
+    slope[present < n] = np.nan
+    return slope
+
+def rolling_filter(values, segments, weights):
+    """
+    Purpose: A fixed weighted sum of each trailing window of len(weights)
+    values in a segment:
+        result[t] = sum over j of weights[j] * values[t - len(weights) + 1 + j]
+    Unlike the running-sum kernels, each result only depends on the values
+    in its own window, so non-integer data (e.g. logs) gets the same result
+    whatever else is in the column. The loop is over the window.
+    Input: values, an array in group order
+    Returns: an array, NaN unless the window holds len(weights) values
+    """
+    window = len(weights)
+    result = np.full(len(values), np.nan)
+    if window > len(values):
+        return result
+    result[window-1:] = 0
+    for (j, weight) in enumerate(weights):
+        result[window-1:] += weight * values[j:len(values)-window+1+j]
+    result[segments.pos < window - 1] = np.nan
+    return result
+
+def rolling_sum_every(values, segments, count, step):
+    """
+    Purpose: Sum {count} values {step} rows apart, ending at each row of a
+    segment, e.g. the last 4 values on the same weekday as the row for 
+    daily data with step 7
+    Input: values, an array in group order
+    Returns: an array, NaN unless all {count} values are in the segment
+    """
+    result = np.where(segments.pos >= (count - 1) * step, 0.0, np.nan)
+    for k in range(count):
+        lag = k * step
+        if lag >= len(values):
+            break
+        result[lag:] += values[:len(values)-lag]
+    return result
+
+def centered_mean(values, segments, window):
+    """
+    Purpose: The mean of a window of {window} values centered on each row 
+    (window//2 rows before it), skipping missing values. Near the ends of a
+    segment the window is cut short, so the latest rows are means of fewer,
+    mostly earlier, values.
+    Input: values, an array in group order
+    Returns: an array, NaN where the window holds no values
+    """
+    before = window // 2
+    ends = np.repeat(segments.starts + segments.lengths, segments.lengths)
+    rows = np.arange(len(values))
+    (total, count) = (np.zeros(len(values)), np.zeros(len(values)))
+    for offset in range(-before, window - before):
+        other = rows + offset
+        use = (segments.pos + offset >= 0) & (other < ends)
+        value = values[np.where(use, other, rows)]
+        use &= ~np.isnan(value)
+        total += np.where(use, value, 0)
+        count += use
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, total / count, np.nan)
+
+def lagged_sum(values, segments, weights):
+    """
+    Purpose: Convolve each segment with a distribution over earlier rows:
+        result[t] = sum over k >= 1 of weights[k-1] * values[t-k]
+    leaving out rows before the start of the segment. The loop is over the
+    lags, so every segment is done at once.
+    Input: values, an array in group order (missing values count as 0)
+           weights, the weight of 1, 2, ... rows back
+    Returns: an array
+    """
+    values = np.where(np.isnan(values), 0, values)
+    result = np.zeros(len(values))
+    for (k, weight) in enumerate(weights, start=1):
+        if k >= len(values):
+            break
+        result[k:] += np.where(segments.pos[k:] >= k, weight * values[:-k], 0)
+    return result
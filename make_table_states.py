@@ -28,6 +28,30 @@ def make_row(state, statefiles, out):
         </tr>
     """, file=out)
 
+def make_hotspots(statedir, out):
+    """ Table of the latest day's hotspot counties saved by plots.py, if any """
+    path = statedir.joinpath('hotspots.csv')
+    if not path.exists():
+        return False
+    df = pd.read_csv(path, parse_dates=['Last_Update'])
+    df = df[df.Last_Update == df.Last_Update.max()]
+    day = df.Last_Update.max().strftime('%B %d, %Y')
+    print(f"""
+    <h3>Hotspots: most new cases per capita on {day}</h3>
+    <table class="serif">
+      <thead>
+        <tr><th>Rank</th><th>County</th><th>State</th><th>Cases/7 days/100K</th></tr>
+      </thead>
+      <tbody>""", file=out)
+    for row in df.itertuples():
+        state = row.Province_State.replace(' ','_')
+        location = f"{row.Admin2.replace(' ','_')}_County_{state}"
+        plotly_page = f'{state}/graphs.php?location={location}'
+        print(f"""        <tr><td>{row.Rank}</td><td><a href="{plotly_page}">{row.Admin2}</a></td>"""
+              f"""<td>{row.Province_State}</td><td>{row.percap_7:.1f}</td></tr>""", file=out)
+    print("""      </tbody>
+    </table>""", file=out)
+    return True
 
 def main():
     coviddir = os.environ.get('COVIDDIR', None)
@@ -78,6 +102,7 @@ def main():
     for line in open(template):
         line = re.sub(r"TABLE_HTML", f"{tableout}", line)
         line = re.sub(r'PAGE_TITLE', f'SARS-CoV-2: USA', line) 
+        line = re.sub(r'HOTSPOTS_HTML', 'hotspots.html', line)
         print(line, file=phpout, end='')
 
     ####
@@ -88,6 +113,10 @@ def main():
         statefiles = all_files[state]
         make_row(state, statefiles, output)
 
+    # Make the hotspot table
+    with open(f'{statedir}/hotspots.html', 'w') as hotspots:
+        make_hotspots(statedir, hotspots)
+
 
 if __name__=='__main__':
     main()
@@ -49,27 +49,15 @@ fi
 
 export STATEDIR="${COVIDDIR}/states"
 
-python3 plots.py --states Illinois Kentucky Minnesota Missouri Texas Virginia --graph_directory "$COVIDDIR" --no_tqdm & 
-pid1=$!
+# read the data and compute statistics once; the graph processes below share it
+STORE="data/cache/plots-store"
+python3 plots.py --states ALL --prepare --store "$STORE" --graph_directory "$COVIDDIR" --no_tqdm
 
-python3 plots.py --states Georgia Indiana Iowa Kansas Nebraska "North Carolina" Ohio Tennessee --graph_directory "$COVIDDIR" --no_tqdm &
-pid2=$!
-
-python3 plots.py --states Pennsylvania Florida Alabama Arkansas California Michigan Mississippi "New York" Oklahoma "Puerto Rico" Wisconsin "United States" --graph_directory "$COVIDDIR" --no_tqdm &
-pid3=$!
-
-python3 plots.py --states Alaska "American Samoa" Arizona Colorado Connecticut Delaware "District of Columbia" Guam Hawaii Idaho Louisiana Maine Maryland Massachusetts Montana Nevada "New Hampshire" "New Jersey" "New Mexico" "North Dakota" "Northern Mariana Islands" Oregon "Rhode Island" "South Carolina" "South Dakota" Utah Vermont "Virgin Islands" Washington "West Virginia" Wyoming --graph_directory "$COVIDDIR" --no_tqdm &
-pid4=$!
-
-echo -ne "Waiting on process 1\r"
-wait $pid1
-echo -ne "Waiting on process 2\r"
-wait $pid2
-echo -ne "Waiting on process 3\r"
-wait $pid3
-echo -ne "Waiting on process 4\r"
-wait $pid4
-echo "All processes complete.            "
+# make the graphs with a pool of processes that share the prepared data
+if [ -z ${JOBS+x} ]; then
+    JOBS=$(nproc)
+fi
+python3 plots.py --states ALL --graph_directory "$COVIDDIR" --store "$STORE" --jobs "$JOBS" --no_tqdm
 
 # update tables
 for state in Pennsylvania Florida Georgia New_Jersey New_York California North_Carolina Alabama Alaska Arizona Arkansas Colorado Connecticut Delaware District_of_Columbia Guam Hawaii Idaho Illinois Indiana Iowa Kansas Kentucky Louisiana Maine Maryland Massachusetts Michigan Minnesota Mississippi Missouri Montana Nebraska Nevada New_Hampshire New_Mexico North_Dakota Northern_Mariana_Islands Ohio Oklahoma Oregon  Rhode_Island South_Carolina South_Dakota Tennessee Texas Utah Vermont Virginia Virgin_Islands Washington West_Virginia Wisconsin Wyoming Puerto_Rico American_Samoa; do
@@ -20,16 +20,19 @@ from collections import defaultdict
 import os
 import re
 import pathlib
+import shutil
 import sys
 import argparse
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import time
+import concurrent.futures
 
 import covidtracking
 import common
 import jhu
 import genstats
+from cube import CaseCube, rollup, load_groupings
 
 """
 Global variables
@@ -68,9 +71,74 @@ def progress_update(use_tqdm, pbar, pid, label):
         print(f"{pid:8} {label}")
 
 
-def gen_state_plots(state, cdf, rdf, sdf, statedir, tempdir,
-                    ignore_timestamp=False, use_tqdm=True):
+def row_ranges(df, key):
+    """
+    Purpose: Index the rows of each location of df once, so that the rows of
+    a location are sliced out instead of found with a boolean mask over all
+    of df. The unrolled dataframes keep the rows of a location together, so
+    each location is a contiguous range of rows.
+    Input: key, the columns that identify a location, e.g. ['Province_State','Admin2']
+    Returns: a dictionary of key tuple -> slice of rows (or an array of row
+             numbers, if the rows of a location aren't contiguous)
+    """
+    codes = df.groupby(key, sort=False, observed=True).ngroup().to_numpy()
+    new = np.ones(len(codes), dtype=bool)
+    new[1:] = codes[1:] != codes[:-1]
+    starts = np.flatnonzero(new)
+    runs = codes[starts]
+    if len(np.unique(runs)) < len(runs):
+        return {(k if isinstance(k, tuple) else (k,)): rows for (k, rows) 
+                in df.groupby(key, sort=False, observed=True).indices.items()}
+    ends = np.append(starts[1:], len(codes))
+    keys = df[key].iloc[starts].itertuples(index=False, name=None)
+    return {k: slice(start, end) for (k, start, end, code) in zip(keys, starts, ends, runs) 
+            if code >= 0}
+
+def location_indexes(cdf, rdf, sdf):
+    """ The row_ranges of the county, region and state (or national) dfs """
+    return (row_ranges(cdf, ['Province_State','Admin2']), row_ranges(rdf, ['Province_State','Region']),
+            row_ranges(sdf, ['Province_State']))
+
+def location_rows(df, index, *key):
+    """ The rows of one location, e.g. location_rows(cdf, index, 'Pennsylvania', 'Delaware') """
+    return df.iloc[index.get(key, slice(0, 0))]
+
+def state_locations(state, ckeys, rkeys):
+    """
+    Purpose: The counties and regions of a state to make graphs for
+    Input: ckeys and rkeys, the (state, county) and (state, region) keys of
+           every location, e.g. the keys of the row_ranges of cdf and rdf
+    Returns: (sorted list of counties, sorted list of regions)
+    """
+    counties = set(county for (s, county) in ckeys if s == state)
+    counties = set([c for c in counties if not (c.startswith('Out of') \
+        or c.startswith('Unassigned'))])
+    if len(counties) == 1:
+        counties = set() # omit counties where there's only one (e.g. Guam)
+    if state == 'Michigan':
+        counties -= set(['Michigan Department of Corrections (MDOC)', 
+                        'Federal Correctional Institution (FCI)'])
+
+    regions = set(region for (s, region) in rkeys if s == state)
+    return (sorted(counties), sorted(regions))
+
+def publish_state_files(state, statedir, tempdir):
+    """ Move the staged graphs of a state to its published directory """
+    ustate = state.replace(' ','_')
+    print(f'--> Moving staged files: {state}')
+    tempdir_state = pathlib.Path(tempdir, ustate)
+    statedir_state= pathlib.Path(statedir, ustate)
+    move_state_files(tempdir_state, statedir_state, extension='png', chmod=0o644)
+    move_state_files(tempdir_state, statedir_state, extension='html', chmod=0o644)
 
+def gen_state_plots(state, cdf, rdf, sdf, statedir, tempdir,
+                    ignore_timestamp=False, use_tqdm=True, indexes=None):
+    """
+    Purpose: Make the graphs for every county and region of a state, and the
+    state itself
+    Input: indexes, the row_ranges of (cdf, rdf, sdf), if already built
+           (e.g. when cdf holds every state and is shared between calls)
+    """
     ustate = state.replace(' ','_')
     pid = os.getpid()
 
@@ -81,40 +149,28 @@ def gen_state_plots(state, cdf, rdf, sdf, statedir, tempdir,
     outpath = pathlib.Path(f'{tempdir}/{ustate}')
     outpath.mkdir(parents=True, exist_ok=True)  # mkdir if it doesn't exist
 
-    counties = set(cdf[cdf.Province_State==state].Admin2.unique())
-    counties = set([c for c in counties if not (c.startswith('Out of') \
-        or c.startswith('Unassigned'))])
-    if len(counties) == 1:
-        counties = set() # omit counties where there's only one (e.g. Guam)
-    if state == 'Michigan':
-        counties -= set(['Michigan Department of Corrections (MDOC)', 
-                        'Federal Correctional Institution (FCI)'])
-
-    regions = set(rdf[rdf.Province_State==state].Region.unique())
+    (cindex, rindex, sindex) = indexes if indexes is not None else location_indexes(cdf, rdf, sdf)
+    (counties, regions) = state_locations(state, cindex, rindex)
 
     wrapper = (lambda x: tqdm(x)) if use_tqdm else (lambda x: x)
 
     # COUNTIES
-    pbar = wrapper(sorted(counties))
+    pbar = wrapper(counties)
     for county in pbar:
         progress_update(use_tqdm, pbar, pid, f"{state}:{county:20}")
-        create_graphs(cdf[(cdf.Admin2==county)&(cdf.Province_State==state)], output_directory=outpath)
+        create_graphs(location_rows(cdf, cindex, state, county), output_directory=outpath)
                     
     # REGIONS
-    pbar = wrapper(sorted(regions))
+    pbar = wrapper(regions)
     for region in pbar:
         progress_update(use_tqdm, pbar, pid, f"{state}:{region:20}")
-        create_graphs(rdf[(rdf.Region==region)&(rdf.Province_State==state)], output_directory=outpath)
+        create_graphs(location_rows(rdf, rindex, state, region), output_directory=outpath)
 
     # STATE
     progress_update(use_tqdm, pbar, pid, f"{state}")
-    create_graphs(sdf[(sdf.Province_State==state)], output_directory=outpath)
+    create_graphs(location_rows(sdf, sindex, state), output_directory=outpath)
 
-    print(f'--> Moving staged files: {state}')
-    tempdir_state = pathlib.Path(tempdir, ustate)
-    statedir_state= pathlib.Path(statedir, ustate)
-    move_state_files(tempdir_state, statedir_state, extension='png', chmod=0o644)
-    move_state_files(tempdir_state, statedir_state, extension='html', chmod=0o644)
+    publish_state_files(state, statedir, tempdir)
 
 
 def label_dataframe(df):
@@ -148,14 +204,19 @@ def create_graphs(df, output='png', output_directory=None):
     else:
         output = 'inline'
 
-    from plots_plotly import new_case_plotly, yellow_target_plotly, trending_plotly, trending2_plotly, posNeg_rate_plotly
+    from plots_plotly import new_case_plotly, yellow_target_plotly, trending_plotly, trending2_plotly, posNeg_rate_plotly, \
+                             growth_plotly
     pngScale=1 #0.25
-    new_case_plotly(df, label, days=7, output=output, pngScale=pngScale)    
+    # the centered average replaces the trailing one if it was computed (--statistics centered)
+    new_case_plotly(df, label, days=7, centered=('centered_avg_7' in df), output=output, 
+                    pngScale=pngScale)
     yellow_target_plotly(df, label, output=output, pngScale=pngScale)
     if 'slope_14' in df:
         trending_plotly(df, label, days=14, output=output, pngScale=pngScale)
     elif 'trend_14' in df:
         trending2_plotly(df, label, days=14, output=output, pngScale=pngScale)
+    if 'growth_14' in df:
+        growth_plotly(df, label, days=14, output=output, pngScale=pngScale)
     if ('positive' in df.columns): # covidtracking data
         posNeg_rate_plotly(df, label, days=7, output=output, pngScale=pngScale, clip_date='2020-03-15', 
                             tail_prune=True)
@@ -197,10 +258,11 @@ def move_state_files(olddir, newdir, extension='png', chmod=None):
 ###########################################################################
 # Command-line parsing
 
-## Set to all states if necessary
+## Set to all states (and the nation) if necessary
 def set_statelist(states):
     if states == ['ALL']:
-        states = list(common.state_d.values()) + list(common.territory_d.values())
+        states = list(common.state_d.values()) + list(common.territory_d.values()) + \
+                 ['United States']
     return states
 
 def set_outdirs(coviddir):
@@ -227,104 +289,371 @@ def parse_cmdline():
                         default=defaultdir)
     parser.add_argument('--no_trends', help="Disable trends for counties", action='store_true')
     parser.add_argument('--no_tqdm', action='store_true', help="Turn off tqdm")
+    parser.add_argument('--workers', type=int, default=1, 
+                        help='Number of processes to compute the statistics with (default: 1)')
+    parser.add_argument('--statistics', nargs='+', default=[], 
+                        choices=list(genstats.OPTIONAL_STATISTICS),
+                        help='Optional statistics to compute as well (see genstats.OPTIONAL_STATISTICS)')
+    parser.add_argument('--jobs', type=int, default=1, 
+                        help='Number of processes to make the graphs with (default: 1)')
+    parser.add_argument('--store', help='Directory of prepared data shared between processes. '
+                        'Without --prepare, graphs are built from this data instead of the JHU data.')
+    parser.add_argument('--prepare', action='store_true', 
+                        help='Compute the data for --states, save it to --store and exit.')
     pargs = parser.parse_args()
     args = vars(pargs)
 
     if args['ignore_timestamp']: print("WARNING: Ignoring timestamp",file=sys.stderr)
+    if args['prepare'] and not args['store']: parser.error('--prepare requires --store')
 
     return args
 
 ###########################################################################
 # One-off graphs
-def one_off(cdf, rdf, sdf, state=None, county=None, region=None, outpath=None):
+def one_off(cdf, rdf, sdf, state=None, county=None, region=None, outpath=None, indexes=None):
+    (cindex, rindex, sindex) = indexes if indexes is not None else location_indexes(cdf, rdf, sdf)
     if county is not None:
-        create_graphs(cdf[(cdf.Province_State==state)&(cdf.Admin2==county)], output_directory=outpath)
+        create_graphs(location_rows(cdf, cindex, state, county), output_directory=outpath)
     elif region is not None:
-        create_graphs(rdf[(rdf.Province_State==state)&(rdf.Region==region)], output_directory=outpath)
+        create_graphs(location_rows(rdf, rindex, state, region), output_directory=outpath)
     else:
-        create_graphs(sdf[(sdf.Province_State==state)], output_directory=outpath)
+        create_graphs(location_rows(sdf, sindex, state), output_directory=outpath)
 ###########################################################################
 def read_data(clip_date=None):
     """
     Purpose: Read data sources from JHU and covidtracking.com
     Input: clip_date, a datetime object representing the earliest date to store
     Returns: 
-      - cdf (dataframe with county-date rows)
+      - jhudf (dataframe with one row per county and one column per date,
+               for all states)
       - ct_df (covidtracking data)
     """    
-    (_, _, cdf) = jhu.read_annotated_jhu_data(omit_zero_counties=True)
-    if clip_date:
-        cdf = cdf[cdf['Last_Update'] >= clip_date].reset_index(drop=True)
+    (_, jhudf) = jhu.read_annotated_jhu_wide(omit_zero_counties=True, compact=True, clip_date=clip_date)
+    jhu.memory_footprint(jhudf, 'jhudf')
     ct_df = covidtracking.get_data(trim=True, clip_date=clip_date)
 
-    return (cdf, ct_df)
+    return (jhudf, ct_df)
 
 ###########################################################################
-def statedf_to_nationaldf(sdf, ct_df):
+""" The columns of each level's dataframe, ahead of the statistics """
+LEVEL_COLUMNS = {
+    'county': None, # the order jhu.unroll_dates uses
+    'region': ['Last_Update','Region','Province_State','Confirmed','Population'],
+    'state': ['Last_Update','Province_State','Confirmed','Population'],
+    'national': ['Last_Update','Confirmed','Population'],
+    'groupings': ['Last_Update','Grouping','Group','Confirmed','Population'],
+}
+
+def rollup_data(jhudf, states, no_trends=False, stats_dir=None, workers=1, statistics=None):
     """
-    Purpose: Aggregate the state-level df (sdf) into a national-level df.
-    Returns: A new national-level df
+    Purpose: Sum the counties into regions, states and the nation (see 
+      cube.rollup) and compute the statistics of every level in one pass.
+      The state and national totals include every state, but only the 
+      counties and regions of the given states are kept. The groups in
+      data/resources/groupings (see cube.load_groupings) are summed from
+      the counties of every state and get their statistics in the same pass.
+      The county, region and state levels are also ranked each day (see
+      genstats.gen_ranks) among every location of the level, not only
+      those of the given states (see level_ranks).
+    Input: stats_dir, workers and statistics, as for prepare_data
+    Returns: a dictionary of level -> dataframe for the levels in cube.HIERARCHY,
+             plus 'groupings' if any groupings are defined
+    """
+    levels = rollup(CaseCube.from_jhudf(jhudf))
+    groupings = load_groupings()
+    if len(groupings):
+        levels['groupings'] = levels['county'].aggregate_groupings(groupings)
+    ranks = {}
+    for level in ['county', 'region']:
+        rows = np.flatnonzero(levels[level].locations.Province_State.isin(states))
+        ranks[level] = level_ranks(levels[level], rows, workers=workers)
+        levels[level] = levels[level].select(rows)
+
+    # with a stats_dir the county statistics are carried forward from the last run instead
+    names = [level for level in levels if level != 'county' or stats_dir is None]
+    cubes = genstats.gen_cube_statistics([levels[level] for level in names], no_trends=no_trends,
+                                         statistics=statistics, workers=workers)
+    levels.update(zip(names, cubes))
+
+    dfs = {}
+    for (level, cube) in levels.items():
+        columns = LEVEL_COLUMNS[level]
+        if columns is not None:
+            columns = columns + [m for m in cube.metrics if m not in columns]
+        dfs[level] = cube.to_rowdf(columns=columns)
+    if stats_dir is not None:
+        genstats.update_statistics(dfs['county'], ['Admin2','Province_State'], stats_dir, 
+                                   no_trends=no_trends, statistics=statistics, workers=workers)
+    for level in ['county', 'region']:
+        for (column, values) in ranks[level].items():
+            dfs[level][column] = values
+    genstats.gen_ranks(dfs['state'], within=None)
+    return dfs
+
+def level_ranks(cube, rows, workers=1):
+    """
+    Purpose: Rank every location of a level each day, nationally and within
+      its state (see genstats.gen_ranks), before the level is cut down to 
+      the locations in rows. Only the statistics that are ranked (see 
+      genstats.RANKS) are computed for this.
+    Input: cube, a level from cube.rollup
+           rows, the locations to keep, as for CaseCube.select
+    Returns: a dictionary of rank column -> array for the rows of 
+             cube.select(rows).to_rowdf()
+    """
+    statistics = [('percap', [7])]  # gives genstats.RANKS
+    rowdf = genstats.gen_cube_statistics([cube], statistics=statistics, workers=workers)[0].to_rowdf()
+    before = set(rowdf.columns)
+    genstats.gen_ranks(rowdf, within='Province_State')
+    ndays = len(cube.dates)
+    take = (np.asarray(rows)[:, None] * ndays + np.arange(ndays)).ravel()
+    return {column: rowdf[column].to_numpy()[take] for column in rowdf if column not in before}
+
+###########################################################################
+def statedf_add_covidtracking(sdf, ct_df):
     """
-    usdf = sdf.groupby(['Last_Update'])[['Confirmed','Population','positive','negative']].sum().reset_index()
-    usdf['Province_State']="United States"
+    Purpose: Add the covidtracking data to the state-level df (sdf), aligned
+      by (state, day) (see covidtracking.join_states). Each state's rows 
+      after its last covidtracking day (CT_Last_Update) are left out of the
+      covidtracking statistics, since that data isn't always updated when
+      the JHU data is.
+    Side effect: Adds the columns to sdf
+    Returns: sdf
+    """
+    covidtracking.join_states(sdf, ct_df)
+    covidtracking.augment(sdf, window=7, last_valid=sdf.CT_Last_Update)
+
+    return sdf
 
-    genstats.gen_statistics(usdf, groupby=['Province_State'])
-    usdf.sort_values(['Province_State','Last_Update'], inplace=True)
-    usdf.reset_index(drop=True,inplace=True)
-    covidtracking.augment(usdf, window=7, last_valid=max(ct_df.Last_Update))
+def nationaldf_add_covidtracking(usdf, sdf):
+    """
+    Purpose: Add the national totals of the covidtracking data merged into
+      the state-level df (sdf) to the national-level df (usdf)
+    Returns: A new national-level df
+    """
+    cube = CaseCube.from_rowdf(sdf, metrics=['positive','negative'])
+    totals = cube.aggregate([]).to_rowdf(columns=['positive','negative'])
+    usdf = usdf.copy()
+    usdf.insert(3, 'positive', totals['positive'].to_numpy())
+    usdf.insert(4, 'negative', totals['negative'].to_numpy())
+    usdf.insert(5, 'Province_State', "United States")
+    # the totals are valid through the last day of any state
+    usdf['CT_Last_Update'] = sdf.CT_Last_Update.max()
+    covidtracking.augment(usdf, window=7, last_valid=usdf.CT_Last_Update)
 
     return usdf
 
 ###########################################################################
-def countydf_to_statedf(cdf, ct_df):
+def prepare_data(states, no_trends=False, stats_dir=None, workers=1, statistics=None):
     """
-    Purpose: Aggregate the county-level df (cdf) into a state-level df and
-      merge the covidtracking dataframe into this df.
-    Returns: A new state-level df
+    Purpose: Read the data and compute the statistics for all of the graphs 
+    of the given states.
+    Input: stats_dir, if given, where to keep the county statistics between
+           runs so that only the new days are computed (see 
+           genstats.update_statistics)
+           workers, the number of processes to compute the statistics with
+           (see genstats.parallel_statistics)
+           statistics, the statistics to compute (see genstats.STATISTICS,
+           the default, and genstats.optional_statistics)
+    Returns: (cdf, rdf, sdf, usdf, gdf), the county, region, state, national 
+             and user-defined grouping dfs (gdf is None without groupings)
     """
-    sdf = cdf.groupby(['Last_Update','Province_State'])[['Confirmed','Population']].sum().reset_index()
-    genstats.gen_statistics(sdf, groupby=['Province_State'])
-    sdf.sort_values(['Province_State','Last_Update'], inplace=True)
-    sdf.reset_index(drop=True,inplace=True)
-    # note that this merge potentially adds junk data in the last rows as the covidtracking
-    # data isn't always updated when the JHU data is updated.
-    sdf = pd.merge(sdf, ct_df, how='left', on=['Last_Update', 'Province_State'])
-    covidtracking.augment(sdf, window=7, last_valid=max(ct_df.Last_Update))
+    clip_date = pd.to_datetime('03/01/2020')
+    (jhudf, ct_df) = read_data(clip_date=clip_date)
+
+    dfs = rollup_data(jhudf, states, no_trends=no_trends, stats_dir=stats_dir, workers=workers,
+                      statistics=statistics)
+    sdf = statedf_add_covidtracking(dfs['state'], ct_df)
+    usdf = nationaldf_add_covidtracking(dfs['national'], sdf)
+
+    return (dfs['county'], dfs['region'], sdf, usdf, dfs.get('groupings'))
 
-    return sdf
 ###########################################################################
-def countydf_to_regiondf(cdf):
+def save_hotspots(cdf, statedir, k=25):
     """
-    Purpose: Aggregate the county-level df (cdf) into a state-level df
-    Returns: A new state-level df
+    Purpose: Save the {k} counties with the most new cases per capita on each
+    day (see genstats.gen_hotspots) for make_table_states.py
+    Input: cdf, the counties of every state
+    Side effect: Writes {statedir}/hotspots.csv
     """
-    rdf = cdf.groupby(['Last_Update','Region','Province_State'])[['Confirmed','Population']].sum().reset_index()
-    genstats.gen_statistics(rdf, groupby=['Region'])
-    rdf.sort_values(['Province_State','Region','Last_Update'], inplace=True)
-    rdf.reset_index(drop=True,inplace=True)
+    hotspots = genstats.gen_hotspots(cdf, ['Admin2','Province_State'], metric='percap_7', k=k)
+    hotspots.to_csv(pathlib.Path(statedir, 'hotspots.csv'), index=False, float_format='%.1f')
 
-    return rdf
 ###########################################################################
-if __name__ == '__main__':
-    args = parse_cmdline()
-    states = set_statelist(args['states'])
-    clip_date = pd.to_datetime('03/01/2020')
-    (cdf, ct_df) = read_data(clip_date=clip_date)
+# Prepared data shared between processes
+#
+# p_update.sh prepares the data once with --prepare and then makes the
+# graphs with a pool of processes (--jobs) that reads it. Each level
+# (county, region, state, nation, user-defined groupings) is saved as a 
+# CaseCube that the processes memory-map, so they share one copy of it.
+
+STORE_LEVELS = ['county', 'region', 'state', 'national', 'groupings']
+
+def save_store(storedir, dfs):
+    """
+    Purpose: Save the (cdf, rdf, sdf, usdf, gdf) dataframes to storedir.
+    Levels that are None are removed from the store.
+    """
+    for (level, df) in zip(STORE_LEVELS, dfs):
+        path = pathlib.Path(storedir, level)
+        if df is not None:
+            CaseCube.from_rowdf(df).save(path)
+        elif path.exists():
+            shutil.rmtree(path)
+
+def attach_store(storedir):
+    """
+    Purpose: Memory-map the data saved by save_store
+    Returns: a list of CaseCubes for the county, region, state, national and
+             grouping levels (None for a level that wasn't saved)
+    """
+    paths = [pathlib.Path(storedir, level) for level in STORE_LEVELS]
+    return [CaseCube.attach(path) if path.exists() else None for path in paths]
+
+def state_frames(state, cubes):
+    """
+    Purpose: Unroll the rows of the attached store that belong to one state
+    Returns: (cdf, rdf, statedf) for the state ('United States' for the nation)
+    """
+    (ccube, rcube, scube, uscube) = cubes[:4]
+    cdf = ccube.select(ccube.state_rows(state)).to_rowdf()
+    rdf = rcube.select(rcube.state_rows(state)).to_rowdf()
+    statecube = uscube if (state == 'United States') else scube
+    statedf = statecube.select(statecube.state_rows(state)).to_rowdf()
+    return (cdf, rdf, statedf)
 
-    sdf = countydf_to_statedf(cdf, ct_df)
-    usdf= statedf_to_nationaldf(sdf, ct_df)
+###########################################################################
+# Rendering with a pool of processes
+#
+# With --jobs N the data is read and the statistics are computed once, and
+# the graphs of each county, region and state are a separate task for a pool
+# of N processes. The tasks wait in one queue that every worker takes the 
+# next task from when it is done with the last one, so the load balances
+# itself instead of depending on a hand-picked split of the states. A state
+# is published as soon as all of its tasks are done. Every location has a
+# row for every day and gets about the same graphs, so the tasks cost about
+# the same; there is no per-task estimate. The tasks are only ordered by the
+# size of their state (its number of locations), so that the big states are
+# done, and published, first.
+
+RENDER_LEVELS = ['county', 'region', 'state', 'national']
+
+render_data = None  # (dfs, indexes) or (cubes, None) in a render worker
+
+def init_render_worker(dfs=None, indexes=None, storedir=None):
+    """
+    Purpose: Give a render worker the data of every location: either the
+    (cdf, rdf, sdf, usdf) dataframes and their row_ranges, or the store to
+    memory-map (see attach_store)
+    """
+    global render_data
+    if storedir is not None:
+        render_data = (attach_store(storedir), None)
+    else:
+        render_data = (dfs, indexes)
 
-    cdf = cdf[cdf['Province_State'].isin(states)].reset_index(drop=True)
-    genstats.gen_statistics(cdf, groupby=['Admin2','Province_State'], no_trends=args['no_trends'])
-    rdf = countydf_to_regiondf(cdf)
+def render_location(level, key, outpath):
+    """
+    Purpose: Make the graphs of one location, in a render worker
+    Input: level, one of RENDER_LEVELS
+           key, the key of the location, e.g. ('Pennsylvania', 'Delaware')
+    Returns: (process id, seconds taken)
+    """
+    start = time.time()
+    (data, indexes) = render_data
+    n = RENDER_LEVELS.index(level)
+    if indexes is None:
+        cube = data[n]
+        df = cube.select(cube.location_row(*key)).to_rowdf()
+    else:
+        df = location_rows(data[n], indexes[n], *key)
+    create_graphs(df, output_directory=outpath)
+    return (os.getpid(), time.time() - start)
 
-    delco = cdf[(cdf.Province_State=='Pennsylvania')&(cdf.Admin2=='Delaware')]
-    pa = sdf[(sdf.Province_State=='Pennsylvania')]
-    southeast = rdf[(rdf.Province_State=='Pennsylvania')&(rdf.Region=='South East')]
+def render_tasks(states, keys, statedir, tempdir, ignore_timestamp=False):
+    """
+    Purpose: List the locations to make graphs for, state by state, the 
+    states with the most locations first
+    Input: keys, the keys of the locations of each of RENDER_LEVELS (e.g. 
+           the row_ranges of each df)
+    Returns: a list of (level, key, outpath) tasks
+    """
+    tasks = []
+    for state in states:
+        ustate = state.replace(' ','_')
+        if (not ignore_timestamp) and is_updated(state, ustate, statedir):
+            continue
+        outpath = pathlib.Path(f'{tempdir}/{ustate}')
+        outpath.mkdir(parents=True, exist_ok=True)
+        (counties, regions) = state_locations(state, keys[0], keys[1])
+        state_level = 'national' if (state == 'United States') else 'state'
+        locations = [('county', (state, c)) for c in counties] + \
+                    [('region', (state, r)) for r in regions] + [(state_level, (state,))]
+        tasks += [(level, key, outpath, len(locations)) for (level, key) in locations]
+    tasks.sort(key=lambda t: -t[3]) # stable, so each state's tasks stay together
+    return [task[:3] for task in tasks]
+
+def parallel_render(tasks, jobs, statedir, tempdir, use_tqdm=True, **init):
+    """
+    Purpose: Make the graphs of the tasks from render_tasks with a pool of
+    {jobs} processes, and report the throughput of each one
+    Input: init, the data for init_render_worker
+    Side effect: Publishes each state when its graphs are done
+    """
+    remaining = defaultdict(int)
+    for (level, key, outpath) in tasks:
+        remaining[key[0]] += 1
+    (count, busy) = (defaultdict(int), defaultdict(float))
+    print(f'Making graphs for {len(tasks)} locations in {len(remaining)} states '
+          f'with {jobs} processes')
+    start = time.time()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=init_render_worker,
+                                                initargs=tuple(init.get(k) for k in 
+                                                               ['dfs', 'indexes', 'storedir'])) as pool:
+        futures = {pool.submit(render_location, *task): task for task in tasks}
+        done = concurrent.futures.as_completed(futures)
+        for future in (tqdm(done, total=len(futures)) if use_tqdm else done):
+            (pid, seconds) = future.result()
+            count[pid] += 1
+            busy[pid] += seconds
+            state = futures[future][1][0]
+            remaining[state] -= 1
+            if remaining[state] == 0:
+                publish_state_files(state, statedir, tempdir)
+    elapsed = time.time() - start
+
+    print(f'Made graphs for {len(tasks)} locations in {elapsed:.1f}s '
+          f'({len(tasks) / max(elapsed, 1e-9):.1f}/s)')
+    for pid in sorted(count):
+        print(f'{pid:8}: {count[pid]:5} locations, busy {busy[pid]:7.1f}s '
+              f'({100 * busy[pid] / max(elapsed, 1e-9):3.0f}%), {count[pid] / max(busy[pid], 1e-9):.1f}/s')
+
+###########################################################################
+if __name__ == '__main__':
+    args = parse_cmdline()
+    states = set_statelist(args['states'])
 
     coviddir = args['graph_directory']
     (statedir, tempdir) = set_outdirs(coviddir)
 
+    if args['store'] and not args['prepare']:
+        cubes = attach_store(args['store'])
+    else:
+        # the prepare step runs every day, so it keeps the county statistics for the next run
+        stats_dir = pathlib.Path(args['store'], 'stats') if args['prepare'] else None
+        (cdf, rdf, sdf, usdf, gdf) = prepare_data(states, no_trends=args['no_trends'], 
+                                                  stats_dir=stats_dir, workers=args['workers'],
+                                                  statistics=genstats.optional_statistics(args['statistics']))
+        if args['states'] == ['ALL']: # the list is national, so it needs every county
+            save_hotspots(cdf, statedir)
+        if args['prepare']:
+            save_store(args['store'], (cdf, rdf, sdf, usdf, gdf))
+            sys.exit(0)
+
+        delco = cdf[(cdf.Province_State=='Pennsylvania')&(cdf.Admin2=='Delaware')]
+        pa = sdf[(sdf.Province_State=='Pennsylvania')]
+        southeast = rdf[(rdf.Province_State=='Pennsylvania')&(rdf.Region=='South East')]
+
     ###########################################################################
     # quick fake
     #state = 'Pennsylvania'
@@ -338,11 +667,33 @@ if __name__ == '__main__':
     #one_off(cdf,rdf,sdf,state=state,region=region,outpath=outpath)
     #breakpoint()
     ###########################################################################
+    if args['jobs'] > 1:
+        if args['store']:
+            keys = [cube.index if cube is not None else {} for cube in cubes[:4]]
+            init = {'storedir': args['store']}
+        else:
+            keys = location_indexes(cdf, rdf, sdf) + (row_ranges(usdf, ['Province_State']),)
+            init = {'dfs': (cdf, rdf, sdf, usdf), 'indexes': keys}
+        tasks = render_tasks(states, keys, statedir, tempdir, 
+                             ignore_timestamp=args['ignore_timestamp'])
+        parallel_render(tasks, args['jobs'], statedir, tempdir, use_tqdm=(not args['no_tqdm']), **init)
+        sys.exit(0)
+
+    if not args['store']:
+        # every state is sliced out of the same dfs, so index them once
+        indexes = location_indexes(cdf, rdf, sdf)
+        national_indexes = indexes[:2] + (row_ranges(usdf, ['Province_State']),)
     for state in states:
-        statedf = usdf if (state == 'United States') else sdf
-        gen_state_plots(state, cdf, rdf, statedf, statedir, tempdir,
+        if args['store']:
+            (state_cdf, state_rdf, statedf) = state_frames(state, cubes)
+            state_indexes = None
+        else:
+            (state_cdf, state_rdf) = (cdf, rdf)
+            statedf = usdf if (state == 'United States') else sdf
+            state_indexes = national_indexes if (state == 'United States') else indexes
+        gen_state_plots(state, state_cdf, state_rdf, statedf, statedir, tempdir,
                         ignore_timestamp=args['ignore_timestamp'],
-                        use_tqdm=(not args['no_tqdm']))
+                        use_tqdm=(not args['no_tqdm']), indexes=state_indexes)
 
 ###########################################################################
 
@@ -22,6 +22,8 @@ import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import covidtracking
 import common
+# keyed-join annotation of regions (PA, NY, MN, CA, GA) and populations
+from jhu import annotate_regions, annotate_populations
 
 
 """
@@ -39,22 +41,6 @@ confirmed_csv = f'{series_loc}/time_series_covid19_confirmed_US.csv'
 ###########################################################################
 # Locality Selection
 
-## Annotate the dataframe with region information, as available
-def annotate_regions(df, region_df):
-    """ Annotate the dataframe with the region, as available (PA, NY, MN, CA, GA) """
-    region_map = defaultdict(lambda: np.nan)
-    for d in region_df.to_dict('records'):
-        region_map[(d['Province_State'], d['Admin2'])] = d['Region']
-    df['Region'] = df[['Province_State', 'Admin2']].apply(lambda x: region_map[(x[0], x[1])], axis=1)
-
-## Annotate the dataframe with populations
-def annotate_populations(df, pop_df):
-    """ Annotate the dataframe with populations """
-    pop_map = defaultdict(lambda: np.nan)
-    for d in pop_df.to_dict('records'):
-        pop_map[d['Province_State'], d['Admin2']] = d['Population']
-    df['Population'] = df.loc[:,['Province_State','Admin2']].apply(lambda x: pop_map[x[0], x[1]], axis=1)
-
 ## Discard counties with no cases (likely folded into a single county by JHU)
 def omit_zero_counties(df):    
     # find which columns are dates and merge them
@@ -55,12 +55,17 @@ def new_case_plotly(df, label, days=14, centered=False, output=None, pngScale=No
         )
     )
 
+    # centered on each day (without the trailing average's lag), if computed
+    if centered and f'centered_avg_{days}' in df:
+        (average, name) = (df[f'centered_avg_{days}'], f'{days} day centered average')
+    else:
+        (average, name) = (df[f'day_avg_{days}'], f'{days} day average')
     fig.add_trace( # moving average
         go.Scatter(
             x = df.Last_Update,
-            y = df[f'day_avg_{days}'],
+            y = average,
             mode = 'lines',
-            name = f'{days} day average',
+            name = name,
             line_color = plt_color['blue'],
             hovertemplate = '<b>%{y:.1f}</b>',
         )
@@ -209,6 +214,74 @@ def trending2_plotly(df, label, days=14, output=None, pngScale=None):
     write_figure_plotly(fig, output, title, 'trend', pngScale=pngScale)
 
 
+########################################
+## Daily growth rate, with doubling and halving times
+def growth_plotly(df, label, days=14, output=None, pngScale=None):
+    growth = df[f'growth_{days}'] * 100
+    # days to double (positive) or halve (negative) at that rate
+    doubling = df[f'doubling_{days}'].fillna(-df[f'halving_{days}'])
+
+    def rate_text(g, d):
+        if d > 0:
+            return 'doubles in <b>%.0f</b> days' % d
+        elif d < 0:
+            return 'halves in <b>%.0f</b> days' % -d
+        else: # no doubling or halving time: flat, or unknown (NaN)
+            return 'flat' if g == 0 else ''
+
+    fig = go.Figure()
+    fig.add_trace(
+        go.Scatter(
+            x = df.Last_Update,
+            y = growth.where(growth >= 0, 0),
+            name = 'Growing',
+            line_color = 'red',
+            fill = 'tozeroy',
+            hoverinfo = 'none',
+        )
+    )
+    fig.add_trace(
+        go.Scatter(
+            x = df.Last_Update,
+            y = growth.where(growth <= 0, 0),
+            name = 'Shrinking',
+            line_color = 'green',
+            fill = 'tozeroy',
+            hoverinfo = 'none',
+        )
+    )
+    fig.add_trace(
+        go.Scatter(
+            x = df.Last_Update,
+            y = growth,
+            text = list(map(rate_text, growth, doubling)),
+            name = 'Growth rate',
+            line_color = 'black',
+            hovertemplate = '<b>%{y:.1f}%</b> per day<BR>%{text}',
+        )
+    )
+
+    firstday = df.Last_Update.min()
+    lastday = df.Last_Update.max()
+    oneday = pd.tseries.offsets.Day(1)
+
+    layout = go.Layout(
+        showlegend=False,  # updated for inline and html
+        xaxis_title="Date",
+        yaxis_title="Daily growth in new cases",
+        yaxis_ticksuffix="%",
+        font=dict(
+            size=12,
+            color="#7f7f7f"
+        ),
+        hovermode="x unified",
+        xaxis = {'range': [firstday-oneday, lastday+oneday]},
+    )
+    fig.update_layout(layout)
+
+    title = f"Growth rate ({days}-day fit of the 7-day average): {label}"
+    write_figure_plotly(fig, output, title, 'growth', pngScale=pngScale)
+
 ########################################
 ## Yellow target: 50 new cases over 14 days per 100K people
 ## Yellow target: 25 new cases over  7 days per 100K people
@@ -276,9 +349,16 @@ def posNeg_rate_plotly(df, label, days=14, clip_date=None, output=None, pngScale
 
     if tail_prune:
         # automatically stop the graph if it contains invalid data at the end
-        if len(df[df.positive.isnull()]) > 0:
+        if 'CT_Last_Update' in df:
+            # one row per day, so the last valid day gives the number of rows
+            last_valid = df.CT_Last_Update.iloc[0] if len(df) else pd.NaT
+            rows = (last_valid - df.Last_Update.iloc[0]).days + 1 if pd.notnull(last_valid) else 0
+            df = df.iloc[:max(rows, 0)]
+        elif len(df[df.positive.isnull()]) > 0:
             first_invalid_date = min(df[df.positive.isnull()].Last_Update)
             df = df[df['Last_Update'] < first_invalid_date]
+        if len(df) == 0: # no covidtracking data for this location (e.g. the cruise ships)
+            return
 
     ptr_field = f'daily_positive_rate_{days}'
     ptr100_field = df[ptr_field] * 100
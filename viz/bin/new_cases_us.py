@@ -46,9 +46,12 @@ def generate_figure(dff, counties):
                            zoom=3, center = {"lat": 37.0902, "lon": -95.7129},
                            opacity=0.5,
                            range_color=(0, 1000),
-                           labels={'percap_7':'cases/7 days/100K'},
+                           labels={'percap_7':'cases/7 days/100K',
+                                   'percap_7_pct':'percentile (US)',
+                                   'percap_7_state_pct':'percentile (state)'},
                            hover_name="Combined_Key",
-                           hover_data={'percap_7':':.1f', 'FIPS':False},
+                           hover_data={'percap_7':':.1f', 'percap_7_pct':':.0f', 
+                                       'percap_7_state_pct':':.0f', 'FIPS':False},
                            title='New cases/7 days/100K people',
                           )
     fig.update_layout(margin={"r":0,"t":0,"l":0,"b":0})
@@ -58,6 +61,7 @@ def generate_figure(dff, counties):
 if __name__ == '__main__':
     (_,_,cdf) = jhu.read_annotated_jhu_data(omit_zero_counties=False, unmerge_counties=True)
     genstats.gen_statistics(cdf, groupby=['Admin2', 'Province_State'], no_trends=True)
+    genstats.gen_ranks(cdf)
     counties = load_counties(resolution='high')
 
     # delete everything except for the last day in the dataframe
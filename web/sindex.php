@@ -26,6 +26,8 @@
       </tbody>
     </table>
 
+    <?php if (file_exists('HOTSPOTS_HTML')) { include 'HOTSPOTS_HTML'; } ?>
+
     <h4>
       <p>Data updated:  <?php
 			  echo date('l F d, Y \a\t H:i:s', filemtime("/home/richardw/Dropbox/covid/COVID-19/csse_covid_19_data/csse_covid_19_time_series/")); ?><BR />